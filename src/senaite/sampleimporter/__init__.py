@@ -51,6 +51,10 @@ def initialize(context):
     """Initializer called when used as a Zope 2 product."""
 
     from content.sampleimport import SampleImport  # noqa
+    from senaite.sampleimporter import indexing
+
+    # Defer the reindexing of the objects created by bulk imports
+    indexing.install()
 
     logger.info("*** Initializing SENAITE.SAMPLEIMPORTER ***")
     types = listTypes(PRODUCT_NAME)
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.CORE.LISTING is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import json
+
+from bika.lims import api
+from plone.protect import CheckAuthenticator
+from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+from senaite.sampleimporter import jobs
+from senaite.sampleimporter import parallel
+from senaite.sampleimporter import timing
+from senaite.sampleimporter import senaiteMessageFactory as _
+from senaite.sampleimporter.browser import BaseView
+
+
+class SampleImportQueueView(BaseView):
+    """Queues the validate or import job of a SampleImport. A GET request
+    shows the form to confirm the job, which is queued on POST
+    """
+    template = ViewPageTemplateFile("templates/sampleimport_queue.pt")
+
+    def __call__(self):
+        self.action = self.request.form.get("action")
+        url = self.context.absolute_url()
+        if self.action not in jobs.ACTIONS:
+            return self.redirect(url, _("Unknown action"), "error")
+        if self.request.get("REQUEST_METHOD") != "POST":
+            return self.template()
+        CheckAuthenticator(self.request)
+        if not jobs.queue_job(self.context, self.action):
+            return self.redirect(url, _("A job is already pending"), "warning")
+        return self.redirect(url, _("The job has been queued"))
+
+    @property
+    def action_title(self):
+        """Returns the title of the button that queues the job
+        """
+        if self.action == "import":
+            return self.context.translate(_("Import"))
+        return self.context.translate(_("Validate"))
+
+
+class SampleImportProgressView(BaseView):
+    """Returns the state of the job of a SampleImport as JSON
+    """
+
+    def __call__(self):
+        self.request.response.setHeader("Content-Type", "application/json")
+        self.request.response.setHeader("Cache-Control", "no-cache")
+        return json.dumps(self.get_progress())
+
+    def get_progress(self):
+        """Returns the progress of the job of the SampleImport
+        """
+        context = self.context
+        job = jobs.get_job(context)
+        total = int(context.getNrSamples() or 0)
+        info = {
+            "uid": api.get_uid(context),
+            "review_state": api.get_review_status(context),
+            "job": None,
+            "processed": 0,
+            "total": total,
+            "errors": len(context.getErrors()),
+            "timings": self.get_timings(),
+        }
+        if job is None:
+            return info
+        info["job"] = {
+            "action": job["action"],
+            "state": job["state"],
+            "message": job["message"],
+        }
+        if job["action"] == "import":
+            # the imported rows are committed per chunk or range
+            info["processed"] = context.getImportedRows()
+            ranges = parallel.get_ranges(context)
+            if ranges is not None:
+                info["processed"] += parallel.get_imported_rows(ranges)
+        elif job["state"] == jobs.DONE:
+            info["processed"] = total
+        return info
+
+    def get_timings(self):
+        """Returns the timings of the stages of the SampleImport
+        """
+        timings = {}
+        for stage, record in timing.get_timings(self.context).items():
+            timings[stage] = dict(record, finished=str(record["finished"]))
+        return timings
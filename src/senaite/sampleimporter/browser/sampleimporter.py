@@ -18,22 +18,29 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import os
+import json
+
+import transaction
 from bika.lims import api
 from bika.lims import bikaMessageFactory as _
 from bika.lims.browser import BrowserView, ulocalized_time
 from bika.lims.browser.bika_listing import BikaListingView
 from bika.lims.interfaces import IClient
+from bika.lims.utils import get_link
 from bika.lims.utils import tmpID
-from bika.lims.workflow import getTransitionDate
 from plone.app.contentlisting.interfaces import IContentListing
 from plone.app.layout.globals.interfaces import IViewView
-from plone.namedfile.file import NamedBlobFile
 from plone.protect import CheckAuthenticator
 from Products.Archetypes.utils import addStatusMessage
-from Products.CMFCore.utils import getToolByName
-from Products.CMFCore.WorkflowCore import WorkflowException
 from Products.Five.browser.pagetemplatefile import ViewPageTemplateFile
+from senaite.sampleimporter import jobs
+from senaite.sampleimporter import logger
+from senaite.sampleimporter import parser
+from senaite.sampleimporter import records
+from senaite.sampleimporter.catalog import CATALOG_ID as SAMPLEIMPORT_CATALOG
+from senaite.sampleimporter.content.sampleimport import SampleImport
+from senaite.sampleimporter.resolvers import get_catalog_for
+from senaite.sampleimporter.resolvers import get_metadata
 from zope.interface import alsoProvides
 from zope.interface import implements
 
@@ -46,7 +53,7 @@ class SampleImportsView(BikaListingView):
         request.set("disable_plone.rightcolumn", 1)
         alsoProvides(request, IContentListing)
 
-        self.catalog = "portal_catalog"
+        self.catalog = SAMPLEIMPORT_CATALOG
         self.contentFilter = {
             "portal_type": "SampleImport",
             "is_active": True,
@@ -72,6 +79,8 @@ class SampleImportsView(BikaListingView):
         )
         self.title = self.context.translate(_("Sample Imports"))
         self.description = ""
+        # path of a client or contact -> (item, column) that render it
+        self.references = {}
 
         self.columns = {
             "Title": {"title": _("Title")},
@@ -105,42 +114,56 @@ class SampleImportsView(BikaListingView):
             },
         ]
 
-    def folderitems(self, **kwargs):
-        items = super(SampleImportsView, self).folderitems()
-        for x in range(len(items)):
-            if "obj" not in items[x]:
-                continue
-            obj = api.get_object(items[x]["obj"])
-            items[x]["Title"] = obj.title_or_id()
-            items[x]["replace"]["Title"] = "<a href='%s/view'>%s</a>" % (
-                obj.absolute_url(),
-                items[x]["Title"],
-            )
-            items[x]["Creator"] = obj.Creator()
-            items[x]["Filename"] = obj.getFilename()
-            parent = obj.aq_parent
-            items[x]["Client"] = parent if IClient.providedBy(parent) else ""
-            items[x]["replace"]["Client"] = "<a href='%s'>%s</a>" % (
-                parent.absolute_url(),
-                parent.Title(),
-            )
-            contact = obj.getContact()
-            if contact:
-                items[x]["Contact"] = contact
-                items[x]["replace"]["Contact"] = "<a href='%s'>%s</a>" % (
-                    contact.absolute_url(),
-                    contact.Title(),
-                )
-            items[x]["DateCreated"] = ulocalized_time(
-                obj.created(), long_format=True, time_only=False, context=obj
-            )
-            date = getTransitionDate(obj, "validate")
-            items[x]["DateValidated"] = date if date else ""
-            date = getTransitionDate(obj, "import")
-            items[x]["DateImported"] = date if date else ""
+    def folderitem(self, obj, item, index):
+        """Renders the item from the catalog metadata of the brain, so the
+        SampleImport is not woken up
+        """
+        url = api.get_url(obj)
+        item["Title"] = api.get_title(obj) or api.get_id(obj)
+        item["replace"]["Title"] = get_link(url + "/view", item["Title"])
+        item["Creator"] = get_metadata(obj, "Creator") or ""
+        item["Filename"] = get_metadata(obj, "getFilename") or ""
+        for key, name in (("Client", "getClientPath"),
+                          ("Contact", "getContactPath")):
+            path = get_metadata(obj, name)
+            if path:
+                self.references.setdefault(path, []).append((item, key))
+        for key, name in (("DateCreated", "created"),
+                          ("DateValidated", "getDateValidated"),
+                          ("DateImported", "getDateImported")):
+            date = get_metadata(obj, name)
+            item[key] = ulocalized_time(
+                date, long_format=True, time_only=False,
+                context=self.context) if date else ""
+        return item
 
+    def folderitems(self):
+        """Renders the clients and contacts of the items once all items of
+        the page are known
+        """
+        items = super(SampleImportsView, self).folderitems()
+        self.render_references()
         return items
 
+    def render_references(self):
+        """Renders the current titles and the links of the clients and
+        contacts of the page, with one catalog query per portal type
+        """
+        paths = self.references.keys()
+        for portal_type in ("Client", "Contact"):
+            if not paths:
+                break
+            catalog = get_catalog_for(portal_type)
+            brains = catalog(portal_type=portal_type,
+                             path={"query": paths, "depth": 0})
+            for brain in brains:
+                title = api.get_title(brain)
+                link = get_link(api.get_url(brain), title)
+                for item, key in self.references.get(api.get_path(brain), []):
+                    item[key] = title
+                    item["replace"][key] = link
+        self.references = {}
+
 
 class ClientSampleImportsView(SampleImportsView):
     def __init__(self, context, request):
@@ -194,61 +217,137 @@ class ClientSampleImportAddView(BrowserView):
         if form.get("submitted"):
             # Validate form submission
             csvfile = form.get("csvfile")
-            data = csvfile.read()
-            lines = data.splitlines()
-            filename = csvfile.filename
             if not csvfile:
                 addStatusMessage(request, _("No file selected"))
                 return self.template()
 
-            if len(lines) < 3:
+            filename = csvfile.filename
+            # Turn away files that were uploaded before, without parsing
+            file_hash = parser.get_hash(csvfile)
+            duplicate = self.get_duplicate(file_hash)
+            if duplicate is not None:
+                addStatusMessage(request, _(
+                    "This file was already uploaded as ${id}",
+                    mapping={"id": duplicate.getId}), "warning")
+                request.response.redirect(duplicate.getURL())
+                return
+
+            if not parser.has_lines(csvfile, 3):
                 addStatusMessage(request, _("Too few lines in CSV file"))
                 return self.template()
 
-            # Create the sampleimport object
+            # Create the sampleimport object. The upload is copied into the
+            # blob in chunks, so it is never held in memory as a whole
             sampleimport = api.create(self.context, "SampleImport", id=tmpID())
             sampleimport.processForm()
             sampleimport.setTitle(sampleimport.getId())
             sampleimport.Filename = filename
-            sampleimport.OriginalFile = NamedBlobFile(data=data, filename=_(filename))
+            sampleimport.setOriginalFile(csvfile, filename=filename)
 
-            # Setup headers
-            sampleimport.save_header_data()
             sampleimport.schema['Filename'].set(sampleimport, filename)
+            sampleimport.setFileHash(file_hash)
+            sampleimport.reindexObject(idxs=["getFileHash"])
 
-            if sampleimport.getErrors():
-                self.request.response.redirect(sampleimport.absolute_url())
-                return self.template()
-
-            # Save all fields from the file into the sampleimport schema
-            sampleimport.save_sample_data()
-            if sampleimport.getErrors():
-                self.request.response.redirect(sampleimport.absolute_url())
-                return
-
-            # immediate folderbatch creation if required
-            sampleimport.create_or_reference_batch()
-
-            # Attempt first validation
-            try:
-                wft = getToolByName(self.context, 'portal_workflow')
-                wft.doActionFor(sampleimport, 'validate')
-                # TODO wft = api.get_tool('portal_workflow')
-                # wft.doActionFor(sampleimport, 'validate')
-                self.request.response.redirect(sampleimport.absolute_url())
-            except WorkflowException:
-                self.request.response.redirect(
-                    "{}/sampleimports".format(self.context.absolute_url())
-                )
+            # Saving and validating the data is left to the job worker
+            jobs.queue_job(sampleimport, "validate")
+            self.request.response.redirect(sampleimport.absolute_url())
         else:
             return self.template()
 
-    def mkTitle(self, filename):
-        pc = getToolByName(self.context, "portal_catalog")
-        nr = 1
-        while True:
-            newname = "%s-%s" % (os.path.splitext(filename)[0], nr)
-            existing = pc(portal_type="SampleImport", title=newname)
-            if not existing:
-                return newname
-            nr += 1
+    def get_duplicate(self, file_hash):
+        """Returns the brain of an active SampleImport of the client with the
+        same file, if any
+        """
+        catalog = api.get_tool(SAMPLEIMPORT_CATALOG)
+        brains = catalog(portal_type="SampleImport",
+                         getFileHash=file_hash,
+                         is_active=True,
+                         path={"query": api.get_path(self.context)})
+        return brains[0] if brains else None
+
+
+class SampleImportDryRunView(BrowserView):
+    """Checks an uploaded file with the save and validation steps of a
+    SampleImport and returns the errors as JSON. Nothing is stored
+    """
+
+    def __call__(self):
+        # whatever the steps touch, the transaction is never committed
+        transaction.doom()
+        response = self.request.response
+        response.setHeader("Content-Type", "application/json")
+        csvfile = self.request.form.get("csvfile")
+        if not csvfile:
+            response.setStatus(400)
+            return json.dumps({"error": "No file selected"})
+
+        sampleimport = SampleImport(tmpID()).__of__(self.context)
+        sampleimport.set_import_file(parser.parse_upload(csvfile))
+        entries = sampleimport.dry_run()
+        return json.dumps({
+            "valid": not entries,
+            "nr_samples": sampleimport.get_import_file().nr_samples,
+            "errors": entries,
+        })
+
+
+class SampleImportRecordsView(BrowserView):
+    """Creates samples from the NDJSON records posted in the request body.
+
+    The first line is the header record, each further line a sample record.
+    The records are imported while they are read, and the result of each
+    record is streamed back as a NDJSON line once its chunk is committed.
+    If the import fails, the stream ends with an error record after the
+    results of the committed chunks.
+
+    The view is meant to be called by scripts. It only takes NDJSON bodies
+    posted with the application/x-ndjson content type, which browsers do
+    not send across sites without asking first
+    """
+
+    def __call__(self):
+        request = self.request
+        response = request.response
+        if request.get("REQUEST_METHOD") != "POST":
+            transaction.abort()
+            response.setStatus(405)
+            return
+        content_type = request.getHeader("Content-Type") or ""
+        content_type = content_type.split(";")[0].strip().lower()
+        if content_type != records.CONTENT_TYPE:
+            transaction.abort()
+            response.setStatus(415)
+            return json.dumps({"error": "Records must be posted as {}"
+                               .format(records.CONTENT_TYPE)})
+        body = request.get("BODYFILE")
+        if body is None:
+            transaction.abort()
+            response.setStatus(400)
+            return json.dumps({"error": "No records posted"})
+        body.seek(0)
+
+        lines = records.iter_records(body)
+        try:
+            # fails on the header record, before any sample is created
+            chunks = records.import_records(self.context, lines)
+        except ValueError as e:
+            transaction.abort()
+            response.setStatus(400)
+            return json.dumps({"error": str(e)})
+
+        response.setHeader("Content-Type", records.CONTENT_TYPE)
+        try:
+            for results in chunks:
+                self.write(results)
+        except Exception as e:
+            # the results of the committed chunks were sent already
+            logger.exception("Import of records failed")
+            transaction.abort()
+            self.write([{"error": str(e)}])
+        return ""
+
+    def write(self, results):
+        """Streams the results of a chunk of records
+        """
+        self.request.response.write(
+            "".join(json.dumps(result) + "\n" for result in results))
@@ -3,6 +3,8 @@ from bika.lims import bikaMessageFactory as _
 from zope.interface import implements
 from bika.lims.interfaces import IWorkflowActionUIDsAdapter
 from bika.lims import api
+from senaite.sampleimporter import jobs
+from senaite.sampleimporter.interfaces import ISampleImport
 
 
 class WorkflowActionCancelAdapter(WorkflowActionGenericAdapter):
@@ -27,3 +29,31 @@ class WorkflowActionCancelAdapter(WorkflowActionGenericAdapter):
         ids = map(api.get_id, transitioned)
         message = _("Cancelled items: {}").format(", ".join(ids))
         return self.redirect(redirect_url=url, message=message)
+
+
+class WorkflowActionQueueAdapter(WorkflowActionGenericAdapter):
+    """Adapter in charge of the 'validate' and 'import' actions of the
+    SampleImports listing. The transitions are queued as jobs instead of
+    being run within the request
+    """
+    implements(IWorkflowActionUIDsAdapter)
+
+    # transition -> job action. The listing validates the stored data,
+    # without reading the uploaded file again
+    job_actions = {
+        "validate": "revalidate",
+        "import": "import",
+    }
+
+    def __call__(self, action, uids):
+        job_action = self.job_actions[action]
+        objects = filter(ISampleImport.providedBy,
+                         map(api.get_object_by_uid, uids))
+        queued = filter(lambda obj: jobs.queue_job(obj, job_action), objects)
+        if not queued:
+            level = "warning"
+            return self.redirect(message=_("No changes made."), level=level)
+
+        ids = map(api.get_id, queued)
+        message = _("Queued items: {}").format(", ".join(ids))
+        return self.redirect(message=message)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+from App.class_init import InitializeClass
+from senaite.core.catalog.base_catalog import BASE_COLUMNS
+from senaite.core.catalog.base_catalog import BASE_INDEXES
+from senaite.core.catalog.base_catalog import BaseCatalog
+from senaite.sampleimporter.interfaces import ISampleImportCatalog
+from zope.interface import implementer
+
+CATALOG_ID = "senaite_catalog_sampleimport"
+CATALOG_TITLE = "Senaite Sample Import Catalog"
+
+INDEXES = BASE_INDEXES + [
+    # id, indexed attribute, type
+    ("getClientID", "", "FieldIndex"),
+    ("getFilename", "", "FieldIndex"),
+    ("getNrSamples", "", "FieldIndex"),
+    ("getFileHash", "", "FieldIndex"),
+    ("getDateValidated", "", "DateIndex"),
+    ("getDateImported", "", "DateIndex"),
+]
+
+COLUMNS = BASE_COLUMNS + [
+    # attribute name
+    "getFilename",
+    "getNrSamples",
+    "getClientPath",
+    "getContactPath",
+    "getDateValidated",
+    "getDateImported",
+]
+
+TYPES = [
+    # portal_type name
+    "SampleImport",
+]
+
+
+@implementer(ISampleImportCatalog)
+class SampleImportCatalog(BaseCatalog):
+    """Catalog for SampleImport objects
+    """
+
+    def __init__(self):
+        BaseCatalog.__init__(self, CATALOG_ID, CATALOG_TITLE)
+
+    @property
+    def mapped_catalog_types(self):
+        return TYPES
+
+
+InitializeClass(SampleImportCatalog)
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import hashlib
+
+# Kinds of the columns of the "Samples" row
+SPECIAL = "special"
+FIELD = "field"
+SERVICE = "service"
+PROFILE = "profile"
+UNKNOWN = "unknown"
+
+# Columns that are not plain AR schema fields or that need to be resolved
+# differently. The "Samples" column holds the row label
+SPECIAL_COLUMNS = (
+    "Samples",
+    "SampleContainer",
+    "Sampler",
+    "AnalysisSpecification",
+)
+
+# Columns without which no sample can be created
+EXPECTED_COLUMNS = (
+    "SampleType",
+)
+
+# Columns of the grid that are not filled from AR schema fields
+GRID_COLUMNS = (
+    "Analyses",
+    "Profiles",
+)
+
+
+class Column(object):
+    """A column of the "Samples" row, together with the converter for its
+    cell values. Converters are called with the row number, the column name
+    and the non-empty cell value. They return the value to store in the grid
+    row, or None, and raise a ValueError for invalid values
+    """
+
+    def __init__(self, index, name, kind, converter=None):
+        self.index = index
+        self.name = name
+        self.kind = kind
+        self.converter = converter
+
+
+class ColumnPlan(object):
+    """The columns of the "Samples" row, classified once per file
+    """
+
+    def __init__(self):
+        self.columns = []
+        self.missing = []
+        self.unexpected = []
+        # filled by prepare()
+        self.sid_index = None
+        self.converted = []
+        self.services = []
+        self.profiles = []
+
+    def add(self, column):
+        """Adds a column to the plan
+        """
+        self.columns.append(column)
+        if column.kind == UNKNOWN:
+            self.unexpected.append(column.name)
+
+    def get_columns(self, *kinds):
+        """Returns the columns of the given kinds, in file order
+        """
+        return [col for col in self.columns if col.kind in kinds]
+
+    def prepare(self):
+        """Sorts the columns out by the way their cells are handled per row
+        """
+        self.sid_index = self.get_index("Samples")
+        self.converted = [col for col in self.get_columns(SPECIAL, FIELD)
+                          if col.converter]
+        self.services = self.get_columns(SERVICE)
+        self.profiles = self.get_columns(PROFILE)
+
+    def get_index(self, name):
+        """Returns the index of the first column with the given name
+        """
+        for column in self.columns:
+            if column.name == name:
+                return column.index
+        return None
+
+
+def is_checked(value):
+    """Returns whether the cell value of a service or profile column selects
+    the service or profile
+    """
+    return str(value).strip().lower() not in ("", "0", "false")
+
+
+def get_row_hash(gridrow):
+    """Returns the hash of the content of a SampleData row. Blank values
+    are left out, so a row hashes the same after a round trip through the
+    edit form, where every column is submitted
+    """
+    items = []
+    for name, value in sorted(gridrow.items()):
+        if isinstance(value, (list, tuple)):
+            value = tuple(filter(None, map(safe_str, value)))
+        else:
+            value = safe_str(value)
+        if value:
+            items.append((name, value))
+    return hashlib.md5(repr(items)).hexdigest()
+
+
+def safe_str(value):
+    """Returns the value as a stripped utf-8 string
+    """
+    if value is None:
+        return ""
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return str(value).strip()
+
+
+def compile_plan(headers, ar_schema, services, profiles, converters):
+    """Classifies the columns of the "Samples" row as special, AR schema
+    field, service keyword, profile or unknown.
+
+    ar_schema - container of the AR field names
+    services - ServiceResolver of the analysis services
+    profiles - container of the profile titles and keys
+    converters - mapping of special column name -> converter, with the
+        converter for AR schema fields under FIELD
+    """
+    plan = ColumnPlan()
+    for index, name in enumerate(headers):
+        if name in SPECIAL_COLUMNS:
+            column = Column(index, name, SPECIAL, converters.get(name))
+        elif name in ar_schema and name not in GRID_COLUMNS:
+            column = Column(index, name, FIELD, converters.get(FIELD))
+        elif services.is_keyword(name):
+            column = Column(index, name, SERVICE)
+        elif name in profiles:
+            column = Column(index, name, PROFILE)
+        elif name:
+            column = Column(index, name, UNKNOWN)
+        else:
+            # blank cells of the header row
+            continue
+        plan.add(column)
+    plan.missing = [name for name in EXPECTED_COLUMNS if name not in headers]
+    plan.prepare()
+    return plan
@@ -18,25 +18,29 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
-import csv
+import os
 import sys
 import transaction
 
 from AccessControl import ClassSecurityInfo
+from Acquisition import aq_base
 from copy import deepcopy
 from DateTime.DateTime import DateTime
 from bika.lims.browser import ulocalized_time
 from bika.lims.content.bikaschema import BikaSchema
 from bika.lims.idserver import renameAfterCreation
 from bika.lims.interfaces import IClient
-from bika.lims.utils import getUsers, tmpID
+from bika.lims.utils import tmpID
 from bika.lims.utils.analysisrequest import create_analysisrequest
 from bika.lims.vocabularies import CatalogVocabulary
+from bika.lims.workflow import getTransitionDate
 from plone.app.blob.field import FileField as BlobFileField
 from Products.Archetypes.atapi import BaseContent
 from Products.Archetypes.atapi import registerType
 from Products.Archetypes.atapi import Schema
 from Products.Archetypes.public import ComputedWidget
+from Products.Archetypes.public import IntegerField
+from Products.Archetypes.public import IntegerWidget
 from Products.Archetypes.public import LinesField
 from Products.Archetypes.public import LinesWidget
 from Products.Archetypes.public import ReferenceField
@@ -45,23 +49,66 @@ from Products.Archetypes.public import StringField
 from Products.Archetypes.public import StringWidget
 from Products.Archetypes.references import HoldingReference
 from Products.Archetypes.utils import addStatusMessage
-from Products.CMFCore.utils import getToolByName
-from Products.CMFPlone.browser.search import quote_chars
 from Products.DataGridField import Column
 from Products.DataGridField import DataGridField
 from Products.DataGridField import DataGridWidget
 from Products.DataGridField import DatetimeLocalColumn
 from Products.DataGridField import LinesColumn
 from Products.DataGridField import SelectColumn
+from ZODB.POSException import ConflictError
 from senaite.core.browser.widgets import ReferenceWidget as bReferenceWidget
 from senaite.core.catalog import CONTACT_CATALOG
+from senaite.sampleimporter import columns
+from senaite.sampleimporter import errors
+from senaite.sampleimporter import ids
+from senaite.sampleimporter import indexing
+from senaite.sampleimporter import jobs
+from senaite.sampleimporter import parallel
+from senaite.sampleimporter import parser
+from senaite.sampleimporter import validation
+from senaite.sampleimporter.errors import collect_errors
+from senaite.sampleimporter.timing import timed
+from senaite.sampleimporter.timing import timed_stage
 from senaite.sampleimporter.interfaces import ISampleImport
+from senaite.sampleimporter.resolvers import ReferenceResolver
+from senaite.sampleimporter.resolvers import SamplerIndex
+from senaite.sampleimporter.resolvers import ServiceResolver
+from senaite.sampleimporter.resolvers import get_ar_fields
+from senaite.sampleimporter.resolvers import get_client_sample_id_counts
+from senaite.sampleimporter.resolvers import get_profile_index
+from senaite.sampleimporter.resolvers import get_samplers
 from senaite.sampleimporter import logger
 from senaite.sampleimporter import PRODUCT_NAME
 from senaite.sampleimporter import senaiteMessageFactory as _
 from zope.interface import implements
 from bika.lims import api
 
+# Number of rows whose samples are committed together during an import
+IMPORT_CHUNK_SIZE = 100
+
+# Number of times the commit of a chunk is retried after a ConflictError
+IMPORT_RETRIES = 3
+
+# Number of threads that import the rows of a SampleImport in parallel
+IMPORT_WORKERS = int(os.environ.get("SENAITE_SAMPLEIMPORTER_WORKERS", 1))
+
+# Whether the reindexing of the imported objects is deferred to the next
+# catalog search or the end of the chunk
+IMPORT_DEFER_INDEXING = os.environ.get(
+    "SENAITE_SAMPLEIMPORTER_DEFER_INDEXING", "on").lower() not in (
+        "off", "0", "false")
+
+# Whether the sample IDs of a chunk are reserved in one block per ID key
+IMPORT_RESERVE_IDS = os.environ.get(
+    "SENAITE_SAMPLEIMPORTER_RESERVE_IDS", "on").lower() not in (
+        "off", "0", "false")
+
+# What happens to rows whose ClientSampleID is used by a sample of the
+# client already: "create" the sample anyway, "skip" them, or "flag" them
+# with an error and skip them. Client Sample IDs do not have to be unique,
+# so rows are only left out if this is set explicitly
+IMPORT_EXISTING = os.environ.get(
+    "SENAITE_SAMPLEIMPORTER_EXISTING", "create").lower()
 
 OriginalFile = BlobFileField(
     'OriginalFile',
@@ -78,9 +125,17 @@ Filename = StringField(
     ),
 )
 
-NrSamples = StringField(
-    'NrSamples',
+FileHash = StringField(
+    'FileHash',
     widget=StringWidget(
+        label=_('File hash'),
+        visible=False,
+    ),
+)
+
+NrSamples = IntegerField(
+    'NrSamples',
+    widget=IntegerWidget(
         label=_('Number of samples'),
         visible={'view': 'visible', 'edit': 'invisible'},
     ),
@@ -194,6 +249,15 @@ SampleData = DataGridField(
     )
 )
 
+ImportedRows = IntegerField(
+    'ImportedRows',
+    default=0,
+    widget=IntegerWidget(
+        label=_('Imported rows'),
+        visible=False,
+    ),
+)
+
 Errors = LinesField(
     'Errors',
     widget=LinesWidget(
@@ -205,6 +269,7 @@ Errors = LinesField(
 schema = BikaSchema.copy() + Schema((
     OriginalFile,
     Filename,
+    FileHash,
     NrSamples,
     ClientName,
     ClientID,
@@ -212,6 +277,7 @@ schema = BikaSchema.copy() + Schema((
     Batch,
     ClientBatchID,
     SampleData,
+    ImportedRows,
     Errors,
 ))
 
@@ -248,13 +314,7 @@ class SampleImport(BaseContent):
             - Errors are stored on object and displayed to user.
 
         """
-        # Re-set the errors on this SampleImport each time validation
-        # is attempted.
-        # When errors are detected they are immediately appended to this field.
-        self.setErrors([])
-
-        self.validate_headers()
-        self.validate_samples()
+        self.validate_sample_import()
 
         if self.getErrors():
             addStatusMessage(self.REQUEST, _('Validation errors.'), 'error')
@@ -266,93 +326,302 @@ class SampleImport(BaseContent):
             '<script>document.location.href="%s/view"</script>' % (
                 self.absolute_url()))
 
+    @timed("validate", rows=lambda self, result: len(self.getSampleData()))
+    @collect_errors
+    def validate_sample_import(self):
+        """Validates the header and sample data. The errors of both are
+        stored in a single write when the validation ends
+        """
+        # Re-set the errors on this SampleImport each time validation
+        # is attempted.
+        self.setErrors([])
+        self.validate_headers()
+        self.validate_samples()
+
+    @collect_errors
+    def dry_run(self):
+        """Runs the save and validation steps on a SampleImport that is not
+        stored, e.g. to check a file before it is uploaded. No batch is
+        created and the contact is not set. Returns the error entries
+        """
+        self.setErrors([])
+        self.save_header_data(dry_run=True)
+        self.save_sample_data()
+        self.validate_headers()
+        self.validate_samples()
+        return errors.get_collector(self).entries
+
     @security.public
     def getFilename(self):
         """Returns the filename
         """
         return self.getField('Filename').get(self)
 
+    # The following getters are stored as catalog metadata, so the
+    # listings do not need to wake up the SampleImports
+
+    @security.public
+    def getClientPath(self):
+        """Returns the physical path of the client. The title and URL of the
+        client are looked up when the listing is rendered
+        """
+        return api.get_path(self.aq_parent)
+
+    @security.public
+    def getContactPath(self):
+        """Returns the physical path of the primary contact
+        """
+        contact = self.getContact()
+        return api.get_path(contact) if contact else ""
+
+    @security.public
+    def getDateValidated(self):
+        """Returns the date of the last validate transition, if any
+        """
+        return getTransitionDate(self, "validate", return_as_datetime=True)
+
+    @security.public
+    def getDateImported(self):
+        """Returns the date of the import transition, if any
+        """
+        return getTransitionDate(self, "import", return_as_datetime=True)
+
     def at_post_edit_script(self):
+        # the validation resets the errors, but keeps those of the rows
+        # that were not changed in the edit form. It runs as a job, like
+        # the validation of an upload
         workflow = api.get_tool("portal_workflow")
         trans_ids = [t["id"] for t in workflow.getTransitionsFor(self)]
-        if "validate" in trans_ids:
-            self.setErrors([])
-            workflow.doActionFor(self, "validate")
+        if "validate" in trans_ids and not jobs.queue_job(self, "revalidate"):
+            logger.warn("Not validating {}, a job is pending"
+                        .format(self.getId()))
+
+    def workflow_before_import(self):
+        """Create the samples before the state changes, so that an import
+        that fails half way stays valid and can be resumed
+        """
+        self.import_samples()
 
     def workflow_script_import(self):
-        """Create objects from valid SampleImport"""
-        bsc = api.get_tool("senaite_catalog_setup")
+        """Redirect to the client after the samples have been created"""
         client = self.aq_parent
+        self.REQUEST.response.redirect(client.absolute_url())
 
-        profiles = [x.getObject() for x in bsc(portal_type='AnalysisProfile')]
-
-        gridrows = self.schema['SampleData'].get(self)
-        row_cnt = 0
-        for therow in gridrows:
-            row = deepcopy(therow)
-            row_cnt += 1
-
-            # Profiles are titles, profile keys, or UIDS: convert them to UIDs.
-            newprofiles = []
-            for title in row['Profiles']:
-                objects = [x for x in profiles
-                           if title in (x.getProfileKey(), x.UID(), x.Title())]
-                for obj in objects:
-                    newprofiles.append(obj.UID())
-            row['Profiles'] = newprofiles
-
-            # Same for analyses
-            newanalyses = set(self.get_row_services(row) +
-                              self.get_row_profile_services(row))
-
-            # get batch
-            batch = self.schema['Batch'].get(self)
-            if batch:
-                row['Batch'] = batch.UID()
-
-            # Add AR fields from schema into this row's data
-            contact_object = self.getContact()
-            contact_uid =\
-                contact_object.UID() if contact_object else None
-            row['Contact'] = contact_uid
-            if contact_object.getCCContact():
-                cc_contacts =\
-                    [cc.UID() for cc in contact_object.getCCContact()]
-                row['CCContact'] = cc_contacts
-            # Creating analysis request from gathered data
-            # SampleContainers are titled containers in analysis requests.
-            row['Container'] = row.pop('SampleContainer')
-
-            # Naming convention for Analysis specifications in the schema
-            row['Specification'] = row.pop('AnalysisSpecification')
-            row['Specification_uid'] = row.get('Specification')
-            create_analysisrequest(
-                client,
-                self.REQUEST,
-                row,
-                analyses=list(newanalyses),)
+    def get_import_context(self):
+        """Returns the values shared by the samples of all rows
+        """
+        values = {}
+        batch = self.schema['Batch'].get(self)
+        if batch:
+            values['Batch'] = batch.UID()
+        contact_object = self.getContact()
+        values['Contact'] = contact_object.UID() if contact_object else None
+        if contact_object and contact_object.getCCContact():
+            values['CCContact'] =\
+                [cc.UID() for cc in contact_object.getCCContact()]
+        return values
 
-        self.REQUEST.response.redirect(client.absolute_url())
+    def get_row_group(self, row, services, groups):
+        """Returns the profile UIDs and the service UIDs of the row. Rows
+        with the same analyses and profiles share one group, which is only
+        resolved once and kept in the groups dict
+        """
+        key = (tuple(row.get('Analyses') or ()),
+               tuple(row.get('Profiles') or ()))
+        group = groups.get(key)
+        if group is not None:
+            return group
+
+        # Profiles are titles, profile keys, or UIDS: convert them to UIDs.
+        profile_index = get_profile_index()
+        newprofiles = []
+        for title in row.get('Profiles') or ():
+            newprofiles.extend(profile_index.get_uids(title))
+
+        # Same for analyses
+        newanalyses = set(self.get_row_services(row, services) +
+                          self.get_row_profile_services(row))
+
+        group = groups[key] = (newprofiles, list(newanalyses))
+        return group
+
+    def create_sample(self, client, therow, shared, services, groups=None):
+        """Create the sample of a SampleData row. The groups dict keeps the
+        resolved analyses and profiles of the rows imported so far
+        """
+        if groups is None:
+            groups = {}
+        row = deepcopy(therow)
+        profiles, analyses = self.get_row_group(row, services, groups)
+        row['Profiles'] = list(profiles)
+
+        # Add AR fields from schema into this row's data
+        row.update(shared)
+
+        # Creating analysis request from gathered data
+        # SampleContainers are titled containers in analysis requests.
+        row['Container'] = row.pop('SampleContainer', None)
+
+        # Naming convention for Analysis specifications in the schema
+        row['Specification'] = row.pop('AnalysisSpecification', None)
+        row['Specification_uid'] = row.get('Specification')
+        return create_analysisrequest(
+            client,
+            self.REQUEST,
+            row,
+            analyses=list(analyses),)
+
+    @timed("import", rows=lambda self, imported: imported)
+    @collect_errors
+    def import_samples(self, chunk_size=IMPORT_CHUNK_SIZE,
+                       workers=IMPORT_WORKERS):
+        """Create the samples of all SampleData rows. Every chunk_size rows
+        the transaction is committed together with the number of imported
+        rows, so a failed import resumes after the last committed chunk.
+        Chunks that fail to commit with a ConflictError are retried.
+        A chunk_size of 0 imports all rows in the current transaction.
+
+        With more than one worker, the rows are split into ranges of
+        chunk_size rows that are imported by as many threads in parallel.
+        The ranges of an import that did not finish are resumed in ranges,
+        whatever the number of workers.
+
+        Returns the number of samples created by this call
+        """
+        client = self.aq_parent
+        services = ServiceResolver()
+        shared = self.get_import_context()
+        groups = {}
+        collector = errors.get_collector(self)
+
+        gridrows = self.getSampleData()
+        total = len(gridrows)
+        start = self.getImportedRows() or 0
+        if start:
+            logger.info("Resuming import of {} after row {}"
+                        .format(self.getId(), start))
+        skip = self.get_existing_rows(client, gridrows, start)
+        # the ranges of a parallel import that did not finish are imported
+        # in ranges again, so the rows that are done are not imported twice
+        resume_ranges = parallel.has_ranges(self, total)
+        done = set()
+        if resume_ranges:
+            done = parallel.get_done_rows(parallel.get_ranges(self))
+        created = len([index for index in range(start, total)
+                       if index not in skip and index not in done])
+        if resume_ranges or (
+                workers > 1 and chunk_size and total - start > chunk_size):
+            imported = parallel.import_parallel(
+                self, start, chunk_size or total, max(workers, 1),
+                IMPORT_RETRIES, IMPORT_DEFER_INDEXING, IMPORT_RESERVE_IDS,
+                skip)
+            self.setImportedRows(imported)
+            return created
+        attempts = 0
+        while start < total:
+            end = min(start + chunk_size, total) if chunk_size else total
+            mark = len(collector)
+            with ids.reserved_ids(end - start, IMPORT_RESERVE_IDS), \
+                    indexing.deferred_indexing(IMPORT_DEFER_INDEXING):
+                for index in range(start, end):
+                    if index in skip:
+                        continue
+                    self.create_sample(
+                        client, gridrows[index], shared, services, groups)
+            self.setImportedRows(end)
+            if end == total:
+                # the last chunk is committed with the transition
+                break
+            try:
+                transaction.commit()
+            except ConflictError:
+                transaction.abort()
+                del collector.entries[mark:]
+                # resolve the groups again to report their errors again
+                groups.clear()
+                attempts += 1
+                if attempts > IMPORT_RETRIES:
+                    raise
+                logger.warn("Conflict while importing rows {}-{} of {}, "
+                            "retrying".format(start + 1, end, self.getId()))
+                continue
+            logger.info("Imported {}/{} rows of {}"
+                        .format(end, total, self.getId()))
+            attempts = 0
+            start = end
+        return created
+
+    def get_existing_rows(self, client, gridrows, start=0,
+                          mode=IMPORT_EXISTING):
+        """Returns the indexes of the rows whose ClientSampleID is used by a
+        sample of the client already, so they are not imported again. With
+        n samples using an ID, the first n rows with that ID are returned.
+        The samples are looked up with a single catalog query. In "flag"
+        mode, the returned rows from start on are reported as errors
+        """
+        if mode not in ("skip", "flag"):
+            return frozenset()
+        sids = set([row.get("ClientSampleID") for row in gridrows])
+        sids.discard(None)
+        sids.discard("")
+        counts = get_client_sample_id_counts(client, sids)
+        existing = set()
+        for index, row in enumerate(gridrows):
+            sid = row.get("ClientSampleID")
+            if counts.get(sid):
+                counts[sid] -= 1
+                existing.add(index)
+        skipped = sorted(index for index in existing if index >= start)
+        if skipped:
+            logger.info("Skipping {} rows of {} with existing samples"
+                        .format(len(skipped), self.getId()))
+        if mode == "flag":
+            for index in skipped:
+                self.error("Row %s: a sample with Client Sample ID '%s' "
+                           "exists already" % (
+                               index + 1, gridrows[index]["ClientSampleID"]),
+                           row=index + 1, column="ClientSampleID",
+                           code=errors.EXISTING)
+        return frozenset(existing)
+
+    def get_import_file(self):
+        """Returns the sections of the original input file. The file is
+        parsed once and the result is cached for the current file revision
+        """
+        fileobj = self.getOriginalFile()
+        cached = getattr(self, "_v_import_file", None)
+        if not fileobj:
+            if cached and cached[0] is None:
+                # a file set with set_import_file
+                return cached[2]
+            return parser.ImportFile()
+        key = parser.get_file_key(fileobj)
+        if cached and cached[0] == key:
+            return cached[2]
+        with timed_stage(self, "parse") as timer:
+            import_file = parser.parse_file(fileobj)
+            timer.rows = import_file.nr_samples
+        # keep a reference to the file, so its identity is not reused
+        self._v_import_file = (key, fileobj, import_file)
+        return import_file
+
+    def set_import_file(self, import_file):
+        """Sets the parsed sections of a file that is not stored as the
+        original file, e.g. of a file that is only checked
+        """
+        self._v_import_file = (None, None, import_file)
 
     def get_header_values(self):
         """Scrape the "Header" values from the original input file
         """
-        lines = self.getOriginalFile().data.splitlines()
-        reader = csv.reader(lines)
-        header_fields = header_data = []
-        for row in reader:
-            if not any(row):
-                continue
-            if row[0].strip().lower() == 'header':
-                header_fields = [x.strip() for x in row][1:]
-                continue
-            if row[0].strip().lower() == 'header data':
-                header_data = [x.strip() for x in row][1:]
-                break
+        import_file = self.get_import_file()
+        header_fields = import_file.header_fields
+        header_data = import_file.header_data
         if not (header_data or header_fields):
             return None
         if not (header_data and header_fields):
-            self.error("File is missing header row or header data")
+            self.error("File is missing header row or header data",
+                       code=errors.MISSING)
             return None
         # inject us out of here
         values = dict(zip(header_fields, header_data))
@@ -361,8 +630,12 @@ class SampleImport(BaseContent):
             del (values[''])
         return values
 
-    def save_header_data(self):
+    @timed("save_header_data")
+    @collect_errors
+    def save_header_data(self, dry_run=False):
         """Save values from the file's header row into their schema fields.
+        On a dry run, the contact is only looked up, because setting the
+        reference would write to the reference catalog
         """
         client = self.aq_parent
 
@@ -391,60 +664,66 @@ class SampleImport(BaseContent):
         catalog = api.get_tool(CONTACT_CATALOG)
         contacts = catalog(query)
         if contacts:
-            self.schema['Contact'].set(self, contacts[0].UID)
+            if not dry_run:
+                self.schema['Contact'].set(self, contacts[0].UID)
         else:
             if contacts:
                 self.error("Specified contact '%s' does not exist; using '%s'" %
-                            (v, contacts[0].Title()))
+                            (v, contacts[0].Title()), column='Contact',
+                           code=errors.INVALID)
                 self.schema['Contact'].set(self, contacts[0])
             else:
-                self.error("Specified contact '%s' does not exist; and there are no other contacts." % (v))
+                self.error("Specified contact '%s' does not exist; and there are no other contacts." % (v),
+                           column='Contact', code=errors.INVALID)
         del (headers['Contact'])
 
         if headers:
             unexpected = ','.join(headers.keys())
-            self.error("Unexpected header fields: %s" % unexpected)
-
-    def get_sample_values(self):
-        """Read the rows specifying Samples and return a dictionary with
-        related data.
-
-        keys are:
-            headers - row with "Samples" in column 0.  These headers are
-               used as dictionary keys in the rows below.
-            prices - Row with "Analysis Price" in column 0.
-            total_analyses - Row with "Total analyses" in colmn 0 (removed)
-            price_totals - Row with "Total price excl Tax" in column 0
-            samples - All other sample rows.
-
-        """
-        res = {'samples': []}
-        lines = self.getOriginalFile().data.splitlines()
-        reader = csv.reader(lines)
-        next_rows_are_sample_rows = False
-        for row in reader:
-            if not any(row):
-                continue
-            if next_rows_are_sample_rows:
-                vals = []
-                for indx, x in enumerate(row):
-                    if indx != 3:
-                        if indx == 2:
-                            # Here we combine DateSampled and TimeSampled
-                            vals.append(x.strip()+" "+row[3].strip())
-                        else:
-                            vals.append(x.strip())
-                if not any(vals):
-                    continue
-                res['samples'].append(zip(res['headers'], vals))
-            elif row[0].strip().lower() == 'samples':
-                headers = []
-                for x in row:
-                    if x != "TimeSampled":
-                        headers.append(x.strip())
-                res['headers'] = headers
-                next_rows_are_sample_rows = True
-        return res
+            self.error("Unexpected header fields: %s" % unexpected,
+                       code=errors.UNEXPECTED)
+
+    def iter_sample_values(self):
+        """Yields the value tuples of each sample row. The rows of large
+        files are streamed from the blob instead of held in memory
+        """
+        return self.get_import_file().iter_samples()
+
+    def get_column_plan(self, ar_schema, services, profiles, resolver,
+                        samplers, headers=None):
+        """Returns the plan of the columns of the "Samples" row, or of the
+        given headers, with the converters of the special and AR schema
+        field columns attached
+        """
+        def convert_container(row_nr, name, value):
+            uids = resolver.resolve(("SampleContainer",), value)
+            return uids[0] if uids else None
+
+        def convert_sampler(row_nr, name, value):
+            userid = samplers.resolve(value)
+            if userid:
+                return userid
+            if name in ar_schema:
+                return convert_field(row_nr, name, value)
+            return None
+
+        def convert_specification(row_nr, name, value):
+            uids = resolver.resolve(("AnalysisSpec",), value)
+            return uids[0] if uids else None
+
+        def convert_field(row_nr, name, value):
+            return self.munge_field_value(
+                ar_schema, row_nr, name, value, resolver=resolver)
+
+        converters = {
+            "SampleContainer": convert_container,
+            "Sampler": convert_sampler,
+            "AnalysisSpecification": convert_specification,
+            columns.FIELD: convert_field,
+        }
+        if headers is None:
+            headers = self.get_import_file().sample_headers or []
+        return columns.compile_plan(
+            headers, ar_schema, services, profiles, converters)
 
     def get_ar(self):
         """Create a temporary AR to fetch the fields from
@@ -454,152 +733,103 @@ class SampleImport(BaseContent):
             "portal_factory/AnalysisRequest/Request new analyses")
 
     def get_ar_schema(self):
-        """Return the AR schema
+        """Return the field name -> FieldInfo table of the AR schema. The
+        table is cached, so no temporary AR is created on each call
         """
-        logger.info("*** GET AR SCHEMA ***")
-        ar = self.get_ar()
-        return ar.Schema()
+        return get_ar_fields(self)
 
+    @timed("save_sample_data",
+           rows=lambda self, result: len(self.getSampleData()))
+    @collect_errors
     def save_sample_data(self):
         """Save values from the file's header row into the DataGrid columns
         after doing some very basic validation
         """
-        bsc = api.get_tool("senaite_catalog_setup")
-        keywords = bsc.uniqueValuesFor("getKeyword")
-        profiles = []
-        for p in bsc(portal_type='AnalysisProfile'):
-            p = p.getObject()
-            profiles.append(p.Title())
-            profiles.append(p.getProfileKey())
-
-        sample_data = self.get_sample_values()
-        if not sample_data:
-            self.error("No sample data found")
-            return False
+        services = ServiceResolver()
+        profiles = get_profile_index().names
 
-        self.schema['NrSamples'].set(self, len(sample_data.get('samples', [])))
-        # columns that we expect, but do not find, are listed here.
-        # we report on them only once, after looping through sample rows.
-        missing = set()
+        resolver = ReferenceResolver()
+        samplers = SamplerIndex(get_samplers(self))
+        import_file = self.get_import_file()
+        self.schema['NrSamples'].set(self, import_file.nr_samples)
+        ar_schema = self.get_ar_schema()
+        plan = self.get_column_plan(
+            ar_schema, services, profiles, resolver, samplers)
 
-        # This contains all sample header rows that were not handled
-        # by this code
-        unexpected = set()
+        if plan.missing:
+            self.error("SAMPLES: Missing expected fields: %s" %
+                       ','.join(plan.missing), code=errors.MISSING)
 
-        # Save other errors here instead of sticking them directly into
-        # the field, so that they show up after MISSING and before EXPECTED
-        errors = []
+        # look up the distinct values of the reference columns at once
+        self.prefetch_references(plan, ar_schema, resolver)
 
         # This will be the new sample-data field value, when we are done.
         grid_rows = []
-
-        ar_schema = self.get_ar_schema()
         row_nr = 0
-        for row in sample_data['samples']:
-            row = dict(row)
+        for vals in self.iter_sample_values():
             row_nr += 1
-
-            # sid is just for referring the user back to row X in their
-            # in put spreadsheet
-            gridrow = {'sid': row['Samples']}
-            del (row['Samples'])
-
-            # ContainerType - not part of sample or AR schema
-
-            if 'SampleContainer' in row:
-                title = row['SampleContainer']
-                if title:
-                    obj = self.lookup(('SampleContainer',),
-                                      title=row['SampleContainer'])
-                    if obj:
-                        gridrow['SampleContainer'] = obj[0].UID
-                del (row['SampleContainer'])
-
-            if 'Sampler' in row:
-                title = row['Sampler']
-                if title:
-                    Users = getUsers(self, ['Sampler', ])
-                    for name in Users.items():
-                        if title in name[1]:
-                            gridrow['Sampler'] = name[0]
-                            del (row['Sampler'])
-
-            if 'AnalysisSpecification' in row:
-                title = row['AnalysisSpecification']
-                if title:
-                    obj = self.lookup(('AnalysisSpec',),
-                                      title=row['AnalysisSpecification'])
-                    if obj:
-                        gridrow['AnalysisSpecification'] = obj[0].UID
-                del (row['AnalysisSpecification'])
-
-            # match against ar schema
-            for k, v in row.items():
-                if k in ['Analyses', 'Profiles']:
-                    continue
-                if k in ar_schema:
-                    del (row[k])
-                    if v:
-                        try:
-                            value = self.munge_field_value(
-                                ar_schema, row_nr, k, v)
-                            gridrow[k] = value
-                        except ValueError as e:
-                            errors.append(e.message)
-
-            # Count and remove Keywords and Profiles from the list
-            gridrow['Analyses'] = []
-            for k, v in row.items():
-                if k in keywords:
-                    del (row[k])
-                    if str(v).strip().lower() not in ('', '0', 'false'):
-                        gridrow['Analyses'].append(k)
-            gridrow['Profiles'] = []
-            for k, v in row.items():
-                if k in profiles:
-                    del (row[k])
-                    if str(v).strip().lower() not in ('', '0', 'false'):
-                        gridrow['Profiles'].append(k)
-
-            grid_rows.append(gridrow)
+            grid_rows.append(self.get_gridrow(plan, row_nr, vals))
 
         self.setSampleData(grid_rows)
+        # the rows changed, so a previous import checkpoint does not apply
+        self.setImportedRows(0)
+        parallel.remove_ranges(self)
+
+        if plan.unexpected:
+            # Columns such as prices or totals are often left in the
+            # spreadsheet. They are ignored, but do not fail the import
+            logger.warn("Ignored unexpected sample columns: %s" %
+                        ','.join(plan.unexpected))
+
+    def get_gridrow(self, plan, row_nr, vals):
+        """Converts the cell values of a sample row to a SampleData row,
+        using the converters of the column plan
+        """
+        size = len(vals)
 
-        if missing:
-            self.error("SAMPLES: Missing expected fields: %s" %
-                       ','.join(missing))
+        # sid is just for referring the user back to row X in their
+        # in put spreadsheet
+        sid_index = plan.sid_index
+        gridrow = {'sid': vals[sid_index]
+                   if sid_index is not None and sid_index < size else ''}
 
-        for err in errors:
-            self.error(err)
+        for col in plan.converted:
+            if col.index >= size or not vals[col.index]:
+                continue
+            try:
+                value = col.converter(row_nr, col.name, vals[col.index])
+            except ValueError as e:
+                self.error(e.message, row=row_nr, column=col.name,
+                           code=errors.INVALID)
+                continue
+            if value is not None:
+                gridrow[col.name] = value
 
-        if unexpected:
-            self.error("Unexpected header fields: %s" %
-                       ','.join(unexpected))
+        gridrow['Analyses'] = [
+            col.name for col in plan.services
+            if col.index < size and columns.is_checked(vals[col.index])]
+        gridrow['Profiles'] = [
+            col.name for col in plan.profiles
+            if col.index < size and columns.is_checked(vals[col.index])]
+        return gridrow
 
     def get_batch_header_values(self):
         """Scrape the "Batch Header" values from the original input file
         """
-        lines = self.getOriginalFile().data.splitlines()
-        reader = csv.reader(lines)
-        batch_headers = batch_data = []
-        for row in reader:
-            if not any(row):
-                continue
-            if row[0].strip().lower() == 'batch header':
-                batch_headers = [x.strip() for x in row][1:]
-                continue
-            if row[0].strip().lower() == 'batch data':
-                batch_data = [x.strip() for x in row][1:]
-                break
+        import_file = self.get_import_file()
+        batch_headers = import_file.batch_headers
+        batch_data = import_file.batch_data
         if not (batch_data or batch_headers):
             return None
         if not (batch_data and batch_headers):
-            self.error("Missing batch headers or data")
+            self.error("Missing batch headers or data", code=errors.MISSING)
             return None
         # Inject us out of here
         values = dict(zip(batch_headers, batch_data))
         return values
 
+    @timed("create_or_reference_batch")
+    @collect_errors
     def create_or_reference_batch(self):
         """Save reference to batch, if existing batch specified
         Create new batch, if possible with specified values
@@ -634,7 +864,8 @@ class SampleImport(BaseContent):
             self.Batch = batch
             self.setBatch(batch)  # Here we set the new batch
 
-    def munge_field_value(self, schema, row_nr, fieldname, value):
+    def munge_field_value(self, schema, row_nr, fieldname, value,
+                          resolver=None):
         """Convert a spreadsheet value into a field value that fits in
         the corresponding schema field.
         - boolean: All values are true except '', 'false', or '0'.
@@ -646,6 +877,9 @@ class SampleImport(BaseContent):
         it will flag 'validation' errors, as this is the only chance we will
         get to complain about these field values.
 
+        A ReferenceResolver can be passed in, so that reference values of
+        all rows are resolved from the same in-memory mappings.
+
         """
         field = schema[fieldname]
         if field.type == 'boolean':
@@ -657,16 +891,16 @@ class SampleImport(BaseContent):
             if len(value) < 2:
                 raise ValueError('Row %s: value is too short (%s=%s)' % (
                     row_nr, fieldname, value))
-            brains = self.lookup(field.allowed_types, title=value)
-            if not brains:
-                brains = self.lookup(field.allowed_types, UID=value)
-            if not brains:
+            if resolver is None:
+                resolver = ReferenceResolver()
+            uids = resolver.resolve(field.allowed_types, value)
+            if not uids:
                 raise ValueError('Row %s: value is invalid (%s=%s)' % (
                     row_nr, fieldname, value))
             if field.multiValued:
-                return [b.UID for b in brains] if brains else []
+                return uids
             else:
-                return brains[0].UID if brains else None
+                return uids[0]
         if field.type == 'datetime' or field.type == 'datetime_ng':
             try:
                 value = DateTime(value)
@@ -677,6 +911,7 @@ class SampleImport(BaseContent):
                     row_nr, fieldname, value))
         return str(value)
 
+    @collect_errors
     def validate_headers(self):
         """Validate headers fields from schema
         """
@@ -686,60 +921,169 @@ class SampleImport(BaseContent):
         # Verify Client Name
         if self.getClientName() != client.Title():
             self.error("%s: value is invalid (%s)." % (
-                'Client name', self.getClientName()))
+                'Client name', self.getClientName()),
+                column='Client name', code=errors.INVALID)
 
         # Verify Client ID
         if self.getClientID() != client.getClientID():
             self.error("%s: value is invalid (%s)." % (
-                'Client ID', self.getClientID()))
+                'Client ID', self.getClientID()),
+                column='Client ID', code=errors.INVALID)
 
+    @collect_errors
     def validate_samples(self):
         """Scan through the SampleData values and make sure
-        that each one is correct
+        that each one is correct. Rows that did not change since the last
+        validation are not validated again, but keep their errors. The
+        outcome of rows that were validated with the same setup before,
+        e.g. by an earlier upload of the same sheet, is taken from the cache
         """
 
-        bsc = api.get_tool("senaite_catalog_setup")
-        keywords = bsc.uniqueValuesFor("getKeyword")
-        profiles = []
-        for p in bsc(portal_type='AnalysisProfile'):
-            p = p.getObject()
-            profiles.append(p.Title())
-            profiles.append(p.getProfileKey())
+        services = ServiceResolver()
+        profiles = get_profile_index().names
 
+        resolver = ReferenceResolver()
         row_nr = 0
         ar_schema = self.get_ar_schema()
-        for gridrow in self.getSampleData():
+        collector = errors.get_collector(self)
+        version_key = validation.get_version_key()
+        checked, kept = self.get_row_checks(version_key)
+        gridrows = self.getSampleData()
+        hashes = []
+        outcomes = []
+        for gridrow in gridrows:
+            row_nr += 1
+            row_hash = columns.get_row_hash(gridrow)
+            hashes.append(row_hash)
+            if row_nr <= len(checked) and checked[row_nr - 1] == row_hash:
+                # the row did not change since it was validated
+                outcomes.append(kept.get(row_nr, ()))
+            else:
+                # a row with the same content might have been validated
+                # by another import with the same setup
+                outcomes.append(
+                    validation.get_outcome(version_key, row_hash, row_nr))
+
+        # look up the references of the rows to validate at once
+        self.prefetch_gridrow_references(
+            [gridrow for gridrow, found in zip(gridrows, outcomes)
+             if found is None], ar_schema, resolver)
+
+        entries = []
+        row_nr = 0
+        for gridrow, row_hash, found in zip(gridrows, hashes, outcomes):
             row_nr += 1
+            mark = len(collector)
+            if found is None:
+                self.validate_gridrow(gridrow, row_nr, ar_schema, services,
+                                      profiles, resolver)
+                validation.set_outcome(version_key, row_hash, row_nr,
+                                       collector.entries[mark:])
+            else:
+                for entry in found:
+                    collector.add(entry["message"], row=row_nr,
+                                  column=entry["column"], code=entry["code"])
+            entries.extend(collector.entries[mark:])
+        self.set_row_checks(version_key, hashes, entries)
+
+    def prefetch_references(self, plan, ar_schema, resolver):
+        """Looks up the distinct values of the reference columns of the
+        sample rows with the resolver, so each column costs one catalog
+        query per referenced type instead of one per row
+        """
+        types = {}
+        for col in plan.converted:
+            if col.name == "SampleContainer":
+                types[col.index] = ("SampleContainer",)
+            elif col.name == "AnalysisSpecification":
+                types[col.index] = ("AnalysisSpec",)
+            elif col.kind == columns.FIELD and ar_schema[col.name].type in (
+                    "reference", "uidreference"):
+                types[col.index] = ar_schema[col.name].allowed_types
+        if not types:
+            return
+        values = dict((index, set()) for index in types)
+        for vals in self.iter_sample_values():
+            for index, found in values.items():
+                if index < len(vals) and vals[index]:
+                    found.add(vals[index])
+        for index, portal_types in types.items():
+            resolver.prefetch(portal_types, values[index])
+
+    def prefetch_gridrow_references(self, gridrows, ar_schema, resolver):
+        """Looks up the reference values of the SampleData rows at once
+        """
+        values = {}
+        for gridrow in gridrows:
+            for name, value in gridrow.items():
+                field = ar_schema.get(name)
+                if field is None or field.type != "reference" or not value:
+                    continue
+                if not isinstance(value, (list, tuple)):
+                    value = [value]
+                values.setdefault(name, set()).update(value)
+        for name, found in values.items():
+            resolver.prefetch(ar_schema[name].allowed_types, found)
+
+    def get_row_checks(self, version_key):
+        """Returns the hashes of the SampleData rows of the last validation
+        and a mapping of row number -> error entries of the row. Nothing is
+        returned when the setup or the AR schema changed since
+        """
+        checks = getattr(aq_base(self), "_row_checks", None)
+        if not checks or version_key is None or checks[0] != version_key:
+            return (), {}
+        kept = {}
+        for entry in checks[2]:
+            kept.setdefault(entry["row"], []).append(entry)
+        return checks[1], kept
+
+    def set_row_checks(self, version_key, hashes, entries):
+        """Stores the hashes and error entries of the validated rows, with
+        the version key of the setup they were validated with
+        """
+        self._row_checks = (version_key, tuple(hashes), tuple(entries))
 
-            # validate against sample and ar schemas
-            for k, v in gridrow.items():
-                if k in ['Analysis', 'Profiles']:
-                    break
-                if k in ar_schema:
-                    try:
-                        self.validate_against_schema(
-                            ar_schema, row_nr, k, v)
-                    except ValueError as e:
-                        self.error(e.message)
-
-            an_cnt = 0
-            for v in gridrow['Analyses']:
-                if v and v not in keywords:
-                    self.error("Row %s: value is invalid (%s=%s)" %
-                               ('Analysis keyword', row_nr, v))
-                else:
-                    an_cnt += 1
-            for v in gridrow['Profiles']:
-                if v and v not in profiles:
-                    self.error("Row %s: value is invalid (%s=%s)" %
-                               ('Profile Title', row_nr, v))
-                else:
-                    an_cnt += 1
-            if not an_cnt:
-                self.error("Row %s: No valid analyses or profiles" % row_nr)
-
-    def validate_against_schema(self, schema, row_nr, fieldname, value):
+    def validate_gridrow(self, gridrow, row_nr, ar_schema, services,
+                         profiles, resolver):
+        """Validates a SampleData row
         """
+        # validate against sample and ar schemas
+        for k, v in gridrow.items():
+            if k in ['Analysis', 'Profiles']:
+                break
+            if k in ar_schema:
+                try:
+                    self.validate_against_schema(
+                        ar_schema, row_nr, k, v, resolver=resolver)
+                except ValueError as e:
+                    self.error(e.message, row=row_nr, column=k,
+                               code=errors.INVALID)
+
+        an_cnt = 0
+        for v in gridrow['Analyses']:
+            if v and not services.is_keyword(v):
+                self.error("Row %s: value is invalid (%s=%s)" %
+                           (row_nr, 'Analysis keyword', v),
+                           row=row_nr, column='Analyses',
+                           code=errors.INVALID)
+            else:
+                an_cnt += 1
+        for v in gridrow['Profiles']:
+            if v and v not in profiles:
+                self.error("Row %s: value is invalid (%s=%s)" %
+                           (row_nr, 'Profile Title', v),
+                           row=row_nr, column='Profiles',
+                           code=errors.INVALID)
+            else:
+                an_cnt += 1
+        if not an_cnt:
+            self.error("Row %s: No valid analyses or profiles" % row_nr,
+                       row=row_nr, code=errors.NO_ANALYSES)
+
+    def validate_against_schema(self, schema, row_nr, fieldname, value,
+                                resolver=None):
+        """Check the saved value against the AR schema field
         """
         field = schema[fieldname]
         if field.type == 'boolean':
@@ -752,15 +1096,16 @@ class SampleImport(BaseContent):
                     row_nr, fieldname))
             if not value:
                 return value
-            brains = self.lookup(field.allowed_types, UID=value)
-
-            if not brains:
+            if resolver is None:
+                resolver = ReferenceResolver()
+            uid = resolver.resolve_uid(field.allowed_types, value)
+            if not uid:
                 raise ValueError("Row %s: value is invalid (%s=%s)" % (
                     row_nr, fieldname, value))
             if field.multiValued:
-                return [b.UID for b in brains] if brains else []
+                return [uid]
             else:
-                return brains[0].UID if brains else None
+                return uid
         if field.type == 'datetime':
             try:
                 ulocalized_time(DateTime(value), long_format=True,
@@ -770,63 +1115,35 @@ class SampleImport(BaseContent):
                     row_nr, fieldname, value))
         return value
 
-    def lookup(self, allowed_types, **kwargs):
-        """Lookup an object of type (allowed_types).  kwargs is sent
-        directly to the catalog.
-        """
-        at = getToolByName(self, 'archetype_tool')
-        if type(allowed_types) not in (list, tuple):
-            allowed_types = [allowed_types]
-        for portal_type in allowed_types:
-            # TODO: SampleContainer is not found but Container is found,
-            # could be due to Dexterity vs Archetypes
-            if portal_type == 'SampleContainer':
-                catalog = at.catalog_map.get('Container', [None])[0]
-            else:
-                catalog = at.catalog_map.get(portal_type, [None])[0]
-            catalog = getToolByName(self, catalog)
-            kwargs['portal_type'] = portal_type
-            if kwargs.get('title'):
-                kwargs['title'] = quote_chars(kwargs['title'])
-            if kwargs.get('UID'):
-                kwargs['UID'] = quote_chars(kwargs['UID'])
-            brains = catalog(**kwargs)
-            if brains:
-                return brains
-
-    def get_row_services(self, row):
+    def get_row_services(self, row, resolver=None):
         """Return a list of services which are referenced in Analyses.
         values may be UID, Title or Keyword.
         """
-        bsc = api.get_tool("senaite_catalog_setup")
+        if resolver is None:
+            resolver = ServiceResolver()
         services = set()
         for val in row.get('Analyses', []):
-            brains = bsc(portal_type='AnalysisService', getKeyword=val)
-            if not brains:
-                brains = bsc(portal_type='AnalysisService', title=val)
-            if not brains:
-                brains = bsc(portal_type='AnalysisService', UID=val)
-            if brains:
-                services.add(brains[0].UID)
+            uid = resolver.resolve(val)
+            if uid:
+                services.add(uid)
             else:
-                self.error("Invalid analysis specified: %s" % val)
+                self.error("Invalid analysis specified: %s" % val,
+                           column='Analyses', code=errors.INVALID)
         return list(services)
 
     def get_row_profile_services(self, row):
         """Return a list of services which are referenced in profiles
         values may be UID, Title or ProfileKey.
         """
-        bsc = api.get_tool("senaite_catalog_setup")
+        profile_index = get_profile_index()
         services = set()
-        profiles = [x.getObject() for x in bsc(portal_type='AnalysisProfile')]
         for val in row.get('Profiles', []):
-            objects = [x for x in profiles
-                       if val in (x.getProfileKey(), x.UID(), x.Title())]
-            if objects:
-                for service in objects[0].services:
-                    services.add(service["uid"])
+            service_uids = profile_index.get_service_uids(val)
+            if service_uids is not None:
+                services.update(service_uids)
             else:
-                self.error("Invalid profile specified: %s" % val)
+                self.error("Invalid profile specified: %s" % val,
+                           column='Profiles', code=errors.INVALID)
         return list(services)
 
     def Vocabulary_SamplePoint(self):
@@ -874,12 +1191,34 @@ class SampleImport(BaseContent):
         return vocabulary(allow_blank=True, portal_type="SampleContainer")
 
     def Vocabulary_Sampler(self):
-        return getUsers(self, ['Sampler', ])
+        return get_samplers(self)
+
+    def error(self, msg, row=None, column=None, code=None):
+        """Reports an error. Errors reported while a stage runs are
+        collected and stored when the stage ends
+        """
+        collector = errors.get_collector(self)
+        if collector is None:
+            collector = errors.ErrorCollector()
+            collector.add(msg, row=row, column=column, code=code)
+            self.store_errors(collector.entries)
+        else:
+            collector.add(msg, row=row, column=column, code=code)
 
-    def error(self, msg):
-        errors = list(self.getErrors())
-        errors.append(msg)
-        self.setErrors(errors)
+    def store_errors(self, entries):
+        """Appends the error entries to the stored errors in one write
+        """
+        messages = list(self.getErrors())
+        stored = list(self.getErrorEntries()) if messages else []
+        self.setErrors(messages + [entry["message"] for entry in entries])
+        self._error_entries = tuple(stored + list(entries))
+
+    def getErrorEntries(self):
+        """Returns the structured entries of the stored errors
+        """
+        if not self.getErrors():
+            return ()
+        return getattr(aq_base(self), "_error_entries", ())
 
 
 registerType(SampleImport, PRODUCT_NAME)
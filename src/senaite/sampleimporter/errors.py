@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import threading
+
+from Acquisition import aq_base
+from functools import wraps
+
+# Collectors of the running stages of the current thread, keyed by the id of
+# the unwrapped object. They are not stored on the object, because aborting
+# a transaction drops the volatile attributes of persistent objects
+_local = threading.local()
+
+# Error codes
+INVALID = "invalid"
+MISSING = "missing"
+REQUIRED = "required"
+UNEXPECTED = "unexpected"
+NO_ANALYSES = "no-analyses"
+EXISTING = "existing"
+
+
+class ErrorCollector(object):
+    """Collects the errors of an import stage in memory. Each entry is a dict
+    with the row number, column name, error code and message. Row and column
+    are None for errors that do not refer to a cell
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, message, row=None, column=None, code=None):
+        """Adds an error
+        """
+        self.entries.append({
+            "row": row,
+            "column": column,
+            "code": code,
+            "message": message,
+        })
+
+    def get_messages(self):
+        """Returns the messages of the errors, in the order they were added
+        """
+        return [entry["message"] for entry in self.entries]
+
+
+def get_collectors():
+    """Returns the mapping of the collectors of the current thread
+    """
+    collectors = getattr(_local, "collectors", None)
+    if collectors is None:
+        collectors = _local.collectors = {}
+    return collectors
+
+
+def get_collector(context):
+    """Returns the error collector of the running stage, if any
+    """
+    return get_collectors().get(id(aq_base(context)))
+
+
+def set_collector(context, collector):
+    """Sets the error collector of the running stage
+    """
+    get_collectors()[id(aq_base(context))] = collector
+
+
+def remove_collector(context):
+    """Removes the error collector of the running stage
+    """
+    get_collectors().pop(id(aq_base(context)), None)
+
+
+def collect_errors(func):
+    """Decorator for the stage methods of a SampleImport. The errors reported
+    while the stage runs are collected in memory and stored on the object
+    in one write when it ends. Stages called by another stage report to the
+    collector of the outer one
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if get_collector(self) is not None:
+            return func(self, *args, **kwargs)
+        collector = ErrorCollector()
+        set_collector(self, collector)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            remove_collector(self)
+            if collector.entries:
+                self.store_errors(collector.entries)
+    return wrapper
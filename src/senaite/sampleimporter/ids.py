@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import threading
+from contextlib import contextmanager
+
+import transaction
+from bika.lims import api
+from bika.lims.numbergenerator import NumberGenerator
+from senaite.sampleimporter import logger
+from ZODB.POSException import ConflictError
+from zope.component.hooks import getSite
+from zope.component.hooks import setSite
+
+# Reservation of the current thread
+_state = threading.local()
+
+# Guards the installation of the reservation into the number generator
+_lock = threading.Lock()
+
+# Number of reserved_ids blocks that are running, in all threads
+_blocks = [0]
+
+# Number of times a reservation that conflicts with another one is retried
+RESERVE_RETRIES = 10
+
+
+class Reservation(object):
+    """Blocks of sequence numbers reserved by an import, per number key.
+
+    The blocks are reserved in a short transaction of their own that is
+    committed right away, so the transaction of the import does not write
+    the shared counters and does not conflict on them. The numbers of a
+    block whose import is aborted are not given back, which leaves gaps.
+    If the current transaction generated numbers of a key that are not
+    committed yet, the block is reserved within the current transaction
+    """
+
+    def __init__(self, size, detach=True):
+        self.size = max(size, 1)
+        self.detach = detach
+        self.generator = None
+        # key -> [next number, last reserved number, committed]
+        self.blocks = {}
+
+    def generate(self, generator, key):
+        """Returns the next number of the block of the key. A new block is
+        reserved when the block is used up
+        """
+        self.generator = generator
+        block = self.blocks.get(key)
+        if block is None or block[0] > block[1]:
+            first = None
+            oid = get_storage_oid(generator)
+            if self.detach and oid is not None:
+                seen = get_last_number(generator, key)
+                first = run_detached(reserve_committed_block, generator, key,
+                                     self.size, oid, seen)
+            committed = first is not None
+            if not committed:
+                first = reserve_block(generator, key, self.size)
+            last = first + self.size - 1
+            block = self.blocks[key] = [first, last, committed]
+        number = block[0]
+        block[0] += 1
+        return number
+
+    def release(self):
+        """Gives back the unused numbers of each block, unless other numbers
+        of the key have been generated in the meantime. The numbers of
+        committed blocks are given back in a transaction of their own, where
+        the counters are read as last committed
+        """
+        generator = self.generator
+        for key, (next_number, last, committed) in self.blocks.items():
+            if next_number > last:
+                continue
+            if committed:
+                run_detached(release_block, generator, key, next_number, last)
+            else:
+                release_block(generator, key, next_number, last)
+        self.blocks = {}
+
+
+_generate_number = NumberGenerator.__dict__["generate_number"]
+
+
+def get_storage_oid(generator):
+    """Returns the oid of the storage of the number generator, or None if
+    the storage is not stored in the database yet
+    """
+    storage = getattr(generator, "storage", None)
+    return getattr(storage, "_p_oid", None)
+
+
+def get_last_number(generator, key):
+    """Returns the last number generated for the key. Unlike get_number of
+    the generator, which generates the next one, the counter is only read
+    """
+    return generator.storage.get(key) or 0
+
+
+def reserve_block(generator, key, size):
+    """Reserves the next size numbers of the key. Returns the first one
+    """
+    first = _generate_number(generator, key=key)
+    if size > 1:
+        generator.set_number(key, first + size - 1)
+    return first
+
+
+def reserve_committed_block(generator, key, size, oid, seen):
+    """Reserves the next size numbers of the key as last committed. Returns
+    None without reserving if the storage or the number seen by the
+    transaction of the import are not committed yet
+    """
+    if get_storage_oid(generator) != oid:
+        return None
+    if get_last_number(generator, key) < seen:
+        return None
+    return reserve_block(generator, key, size)
+
+
+def release_block(generator, key, next_number, last):
+    """Gives back the numbers from next_number to last of the key, if last
+    is the last number generated for the key. Returns True if the numbers
+    were given back
+    """
+    if get_last_number(generator, key) != last:
+        return None
+    generator.set_number(key, next_number - 1)
+    return True
+
+
+def run_detached(func, *args):
+    """Runs func in a transaction of its own on a separate connection, with
+    the site of that connection as the current site. The transaction is
+    committed if func returns a value other than None and retried when it
+    conflicts. Returns the result of func
+    """
+    portal = api.get_portal()
+    site = getSite()
+    manager = transaction.TransactionManager()
+    conn = portal._p_jar.db().open(transaction_manager=manager)
+    try:
+        app = conn.root()["Application"]
+        for attempt in range(RESERVE_RETRIES + 1):
+            manager.begin()
+            setSite(app.unrestrictedTraverse(portal.getPhysicalPath()))
+            result = func(*args)
+            if result is None:
+                manager.abort()
+                return None
+            try:
+                manager.commit()
+                return result
+            except ConflictError:
+                manager.abort()
+                if attempt == RESERVE_RETRIES:
+                    raise
+    finally:
+        manager.abort()
+        setSite(site)
+        conn.close()
+
+
+def generate_number(self, key="default"):
+    """Generates the next number of the key, from the reserved block of the
+    running import if any
+    """
+    reservation = getattr(_state, "reservation", None)
+    if reservation is None:
+        return _generate_number(self, key=key)
+    return reservation.generate(self, key)
+
+
+def install():
+    """Installs the reservation of numbers into the number generator while
+    reserved_ids blocks are running
+    """
+    with _lock:
+        _blocks[0] += 1
+        if _blocks[0] == 1:
+            NumberGenerator.generate_number = generate_number
+
+
+def uninstall():
+    """Restores the number generator when the last reserved_ids block ends
+    """
+    with _lock:
+        _blocks[0] -= 1
+        if _blocks[0] == 0:
+            NumberGenerator.generate_number = _generate_number
+
+
+@contextmanager
+def reserved_ids(size, enabled=True):
+    """Reserves blocks of size sequence numbers per ID key for the samples
+    created in the block, so the shared counters are written once per key
+    and not once per sample, outside of the transaction of the import. The
+    unused numbers are given back when the block is left. The number
+    generator is patched while blocks are running, and threads without a
+    reservation keep generating numbers as before
+    """
+    if not enabled or getattr(_state, "reservation", None) is not None:
+        yield
+        return
+    reservation = _state.reservation = Reservation(size)
+    install()
+    try:
+        yield
+    finally:
+        _state.reservation = None
+        uninstall()
+    if reservation.blocks:
+        logger.debug("Reserved numbers of {} ID keys"
+                     .format(len(reservation.blocks)))
+        reservation.release()
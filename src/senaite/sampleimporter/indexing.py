@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from Acquisition import aq_base
+from Products.CMFCore.indexing import IndexQueue
+from Products.CMFCore.indexing import REINDEX
+from Products.CMFCore.indexing import getQueue
+from senaite.sampleimporter import logger
+
+# Deferred operations of the current thread
+_state = threading.local()
+
+
+class DeferredOperations(object):
+    """Reindex operations of a bulk import, merged per object
+    """
+
+    def __init__(self):
+        # id of the object -> (object, attributes, update metadata)
+        self.pending = OrderedDict()
+        self.merged = 0
+        # number of times the operations were flushed for a search
+        self.flushes = 0
+
+    def add(self, op, obj, attributes, metadata):
+        """Takes over a reindex operation. Other operations of the same
+        object make a deferred reindex obsolete
+        """
+        key = id(aq_base(obj))
+        if op != REINDEX:
+            self.pending.pop(key, None)
+            return False
+        if key in self.pending:
+            self.merged += 1
+            previous, old_attributes, old_metadata = self.pending[key]
+            if not (attributes and old_attributes):
+                # one of the operations reindexes all indexes
+                attributes = []
+            else:
+                attributes = list(set(old_attributes) | set(attributes))
+            metadata = metadata or old_metadata
+        self.pending[key] = (obj, attributes, metadata)
+        return True
+
+    def get_operations(self):
+        """Returns the merged reindex operations
+        """
+        return [(REINDEX, obj, attributes, metadata)
+                for obj, attributes, metadata in self.pending.values()]
+
+    def pop_operations(self):
+        """Returns the merged reindex operations and forgets them
+        """
+        operations = self.get_operations()
+        self.pending.clear()
+        return operations
+
+
+_process = IndexQueue.process
+
+
+def process(self):
+    """Processes the index queue. During a bulk import, the queue is only
+    processed for catalog searches, which must not find stale entries: the
+    reindex operations are merged per object and processed before the search
+    """
+    deferred = getattr(_state, "deferred", None)
+    if deferred is not None and self.queue:
+        self.optimize()
+        self.queue = [item for item in self.queue
+                      if not deferred.add(*item)]
+        deferred.flushes += 1
+        self.queue = list(self.queue) + deferred.pop_operations()
+    return _process(self)
+
+
+def install():
+    """Installs the deferral of reindex operations into the index queue.
+    The patch is installed once per process, but only acts in the threads
+    that are inside a deferred_indexing block
+    """
+    if IndexQueue.process is not process:
+        IndexQueue.process = process
+
+
+@contextmanager
+def deferred_indexing(enabled=True):
+    """Defers the reindex operations of the current thread until the block
+    ends or a catalog search needs them. Objects that are reindexed several
+    times in between are only reindexed once, in all catalogs. New and
+    removed objects are still (un)indexed right away, so that searches
+    find them
+    """
+    if not enabled or getattr(_state, "deferred", None) is not None:
+        # nested blocks are flushed by the outermost one
+        yield
+        return
+    deferred = _state.deferred = DeferredOperations()
+    try:
+        yield
+    finally:
+        # operations of failed blocks are dropped with the transaction
+        _state.deferred = None
+    queue = getQueue()
+    queue.queue = list(queue.queue) + deferred.get_operations()
+    logger.debug("Flushing {} deferred reindex operations, {} merged, "
+                 "{} flushed before searches"
+                 .format(len(deferred.pending), deferred.merged,
+                         deferred.flushes))
+    queue.process()
@@ -34,3 +34,8 @@ class ISenaiteSampleImporterLayer(IBikaLIMS, ISenaiteLIMS):
 class ISampleImport(Interface):
     """Marker interface for an SampleImport
     """
+
+
+class ISampleImportCatalog(Interface):
+    """Marker interface for the catalog of the SampleImports
+    """
@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import os
+import threading
+import time
+
+import transaction
+from AccessControl.SecurityManagement import newSecurityManager
+from AccessControl.SecurityManagement import noSecurityManager
+from BTrees.OOBTree import OOBTree
+from DateTime import DateTime
+from persistent.mapping import PersistentMapping
+from Products.CMFCore.WorkflowCore import WorkflowException
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from bika.lims import api
+from senaite.sampleimporter import logger
+from zope.annotation.interfaces import IAnnotations
+from zope.component.hooks import setSite
+
+# Annotation key of the job queue on the portal
+QUEUE_KEY = "senaite.sampleimporter.jobs"
+
+# Annotation key of the job record on the SampleImport
+JOB_KEY = "senaite.sampleimporter.job"
+
+# Set this environment variable to "off" to run the jobs within the request
+# that queues them, e.g. on ZEO clients that do not run the worker
+ENV_JOBS = "SENAITE_SAMPLEIMPORTER_JOBS"
+
+# Seconds the worker waits before it looks for new jobs
+POLL_INTERVAL = 5
+
+# Seconds after which a running job is considered abandoned, e.g. because
+# the worker that claimed it was stopped. Imports resume after the last
+# committed chunk when they are claimed again
+CLAIM_TIMEOUT = 6 * 3600
+
+# Number of times a job that failed with a ConflictError is run again
+JOB_RETRIES = 3
+
+# Job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# The worker of this process
+_worker = None
+
+
+def is_enabled():
+    """Returns whether the jobs are run by the background worker
+    """
+    return os.environ.get(ENV_JOBS, "on").lower() not in ("off", "0", "false")
+
+
+def get_queue(portal):
+    """Returns the queue of the portal, a BTree of queue key -> UID of the
+    SampleImport. Keys sort in the order the jobs were queued
+    """
+    annotations = IAnnotations(portal)
+    queue = annotations.get(QUEUE_KEY)
+    if queue is None:
+        queue = annotations[QUEUE_KEY] = OOBTree()
+    return queue
+
+
+def get_job(sampleimport):
+    """Returns the job record of the SampleImport, or None
+    """
+    return IAnnotations(sampleimport).get(JOB_KEY)
+
+
+def is_abandoned(job):
+    """Returns whether the job is running, but its claim timed out
+    """
+    if job["state"] != RUNNING:
+        return False
+    claimed = job.get("claimed")
+    return claimed is None or claimed < time.time() - CLAIM_TIMEOUT
+
+
+def is_pending(sampleimport):
+    """Returns whether a job of the SampleImport is queued or running
+    """
+    job = get_job(sampleimport)
+    if job is None or is_abandoned(job):
+        return False
+    return job["state"] in (QUEUED, RUNNING)
+
+
+def run_validate(sampleimport):
+    """Saves the data of the uploaded file and validates the SampleImport
+    """
+    sampleimport.save_header_data()
+    if not sampleimport.getErrors():
+        sampleimport.save_sample_data()
+    if not sampleimport.getErrors():
+        # immediate folderbatch creation if required
+        sampleimport.create_or_reference_batch()
+        revalidate(sampleimport)
+    # the saved data and errors are part of the catalog metadata
+    sampleimport.reindexObject()
+
+
+def run_revalidate(sampleimport):
+    """Validates the data of the SampleImport again, e.g. after it was
+    changed in the edit form
+    """
+    revalidate(sampleimport)
+    sampleimport.reindexObject()
+
+
+def revalidate(sampleimport):
+    """Runs the validate transition of the SampleImport, if possible
+    """
+    try:
+        wf = api.get_tool("portal_workflow")
+        wf.doActionFor(sampleimport, "validate")
+    except WorkflowException:
+        pass
+
+
+def run_import(sampleimport):
+    """Creates the samples of the SampleImport
+    """
+    wf = api.get_tool("portal_workflow")
+    wf.doActionFor(sampleimport, "import")
+
+
+# Job action -> function that runs it
+ACTIONS = {
+    "validate": run_validate,
+    "revalidate": run_revalidate,
+    "import": run_import,
+}
+
+
+def queue_job(sampleimport, action):
+    """Queues a job of the SampleImport. The job is run by the background
+    worker once the current transaction is committed, or right away if the
+    worker is disabled. Returns False if a job is already pending
+    """
+    if action not in ACTIONS:
+        raise ValueError("Unknown job action: {}".format(action))
+    if is_pending(sampleimport):
+        return False
+    job = PersistentMapping()
+    job["action"] = action
+    job["state"] = QUEUED
+    job["userid"] = api.get_current_user().getId()
+    job["created"] = DateTime()
+    job["message"] = ""
+    IAnnotations(sampleimport)[JOB_KEY] = job
+    if not is_enabled():
+        run_job(sampleimport, job)
+        return True
+    key = "{:017.6f}-{}".format(time.time(), api.get_uid(sampleimport))
+    get_queue(api.get_portal())[key] = api.get_uid(sampleimport)
+    return True
+
+
+def run_job(sampleimport, job):
+    """Runs the job of the SampleImport and records its outcome
+    """
+    job["state"] = RUNNING
+    job["started"] = DateTime()
+    ACTIONS[job["action"]](sampleimport)
+    job["state"] = DONE
+    job["finished"] = DateTime()
+
+
+def login_as(portal, userid):
+    """Logs in the user that queued the job
+    """
+    for acl_users in (portal.acl_users, portal.getPhysicalRoot().acl_users):
+        user = acl_users.getUserById(userid)
+        if user is not None:
+            newSecurityManager(None, user.__of__(acl_users))
+            return True
+    return False
+
+
+def claim_next_job(portal):
+    """Claims the oldest job of the queue that is queued or abandoned and
+    commits the claim. The entries of the jobs that are finished are removed.
+    Returns the queue key, the UID of the SampleImport and the job, or None
+    if there is no job to claim
+    """
+    queue = get_queue(portal)
+    for key, uid in list(queue.items()):
+        sampleimport = api.get_object_by_uid(uid, None)
+        job = sampleimport and get_job(sampleimport)
+        if job is None or job["state"] in (DONE, FAILED):
+            del queue[key]
+            continue
+        if job["state"] == RUNNING and not is_abandoned(job):
+            # run by another worker
+            continue
+        if job["state"] == RUNNING:
+            logger.warn("Claiming abandoned {} job of {}".format(
+                job["action"], uid))
+        # make the running state visible to the progress view
+        job["state"] = RUNNING
+        job["claimed"] = time.time()
+        try:
+            transaction.commit()
+        except ConflictError:
+            # claimed by another worker
+            transaction.abort()
+            return None
+        return key, uid, job
+    transaction.commit()
+    return None
+
+
+def run_next_job(portal):
+    """Claims the oldest job of the queue of the portal and runs it. The
+    job is kept in the queue until it is finished, so the job of a worker
+    that stopped is claimed again once its claim timed out. Returns False
+    if there is no job to run
+    """
+    claimed = claim_next_job(portal)
+    if claimed is None:
+        return False
+    key, uid, job = claimed
+    sampleimport = api.get_object_by_uid(uid)
+    queue = get_queue(portal)
+
+    logger.info("Running {} job of {}".format(job["action"], uid))
+    try:
+        if not login_as(portal, job["userid"]):
+            raise ValueError("User {} not found".format(job["userid"]))
+        run_job(sampleimport, job)
+        queue.pop(key, None)
+        transaction.commit()
+    except ConflictError as e:
+        # the chunks committed so far are kept, so the job can resume
+        transaction.abort()
+        job["attempts"] = job.get("attempts", 0) + 1
+        if job["attempts"] > JOB_RETRIES:
+            logger.error("Job {} of {} failed with too many conflicts"
+                         .format(job["action"], uid))
+            fail_job(job, e)
+            queue.pop(key, None)
+        else:
+            job["state"] = QUEUED
+        transaction.commit()
+    except Exception as e:
+        logger.exception("Job {} of {} failed".format(job["action"], uid))
+        transaction.abort()
+        fail_job(job, e)
+        queue.pop(key, None)
+        transaction.commit()
+    finally:
+        noSecurityManager()
+    return True
+
+
+def fail_job(job, error):
+    """Records the failure of the job
+    """
+    job["state"] = FAILED
+    job["finished"] = DateTime()
+    job["message"] = str(error)
+
+
+class JobWorker(threading.Thread):
+    """Runs the queued jobs of all sites with its own database connection
+    """
+
+    def __init__(self, db, interval=POLL_INTERVAL):
+        super(JobWorker, self).__init__(name="senaite.sampleimporter.jobs")
+        self.daemon = True
+        self.db = db
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.process()
+            except Exception:
+                logger.exception("Sample import worker failed")
+
+    def process(self):
+        """Runs all queued jobs of all sites
+        """
+        conn = self.db.open()
+        try:
+            app = makerequest(conn.root()["Application"])
+            for site in app.objectValues("Plone Site"):
+                setSite(site)
+                while run_next_job(site):
+                    pass
+        finally:
+            transaction.abort()
+            setSite(None)
+            conn.close()
+
+
+def start_worker(event):
+    """Starts the worker of this process once the database is opened
+    """
+    global _worker
+    if _worker is not None or not is_enabled():
+        return
+    _worker = JobWorker(event.database)
+    _worker.start()
+    logger.info("Started sample import worker")
@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import threading
+import time
+
+import transaction
+from AccessControl.SecurityManagement import noSecurityManager
+from BTrees.OOBTree import OOBTree
+from Testing.makerequest import makerequest
+from ZODB.POSException import ConflictError
+from bika.lims import api
+from senaite.sampleimporter import logger
+from senaite.sampleimporter.errors import ErrorCollector
+from senaite.sampleimporter.errors import remove_collector
+from senaite.sampleimporter.errors import set_collector
+from senaite.sampleimporter.ids import reserved_ids
+from senaite.sampleimporter.indexing import deferred_indexing
+from senaite.sampleimporter.jobs import login_as
+from senaite.sampleimporter.resolvers import ServiceResolver
+from zope.annotation.interfaces import IAnnotations
+from zope.component.hooks import setSite
+
+# Annotation key of the row ranges of a parallel import
+RANGES_KEY = "senaite.sampleimporter.ranges"
+
+# Annotation key of the file hash and number of rows the ranges were made for
+RANGES_VERSION_KEY = "senaite.sampleimporter.ranges_version"
+
+# Range states
+PENDING = "pending"
+CLAIMED = "claimed"
+DONE = "done"
+
+# Seconds after which a claimed range is considered abandoned, e.g. because
+# the worker that claimed it was stopped
+CLAIM_TIMEOUT = 1800
+
+
+def get_ranges(sampleimport):
+    """Returns the row ranges of the SampleImport, a BTree of start row ->
+    (end row, state, claim time), or None
+    """
+    return IAnnotations(sampleimport).get(RANGES_KEY)
+
+
+def get_ranges_version(sampleimport, total):
+    """Returns the version of the ranges of the SampleImport with the given
+    number of rows
+    """
+    return (sampleimport.getFileHash(), total)
+
+
+def has_ranges(sampleimport, total):
+    """Returns whether the SampleImport has the ranges of an import of its
+    current rows that did not finish. Ranges made for other rows are removed
+    """
+    if get_ranges(sampleimport) is None:
+        return False
+    version = IAnnotations(sampleimport).get(RANGES_VERSION_KEY)
+    if version == get_ranges_version(sampleimport, total):
+        return True
+    remove_ranges(sampleimport)
+    return False
+
+
+def prepare_ranges(sampleimport, start, total, chunk_size):
+    """Splits the rows from start to total into ranges of chunk_size rows.
+    The ranges of a previous import of the same rows that did not finish
+    are kept
+    """
+    if has_ranges(sampleimport, total):
+        return get_ranges(sampleimport)
+    annotations = IAnnotations(sampleimport)
+    ranges = annotations[RANGES_KEY] = OOBTree()
+    annotations[RANGES_VERSION_KEY] = get_ranges_version(sampleimport, total)
+    for first in range(start, total, chunk_size):
+        ranges[first] = (min(first + chunk_size, total), PENDING, None)
+    return ranges
+
+
+def remove_ranges(sampleimport):
+    """Removes the row ranges of the SampleImport
+    """
+    annotations = IAnnotations(sampleimport)
+    annotations.pop(RANGES_KEY, None)
+    annotations.pop(RANGES_VERSION_KEY, None)
+
+
+def get_imported_rows(ranges):
+    """Returns the number of rows of the ranges that are done
+    """
+    return sum(end - start for start, (end, state, claimed)
+               in ranges.items() if state == DONE)
+
+
+def get_done_rows(ranges):
+    """Returns the indexes of the rows of the ranges that are done
+    """
+    done = set()
+    for start, (end, state, claimed) in ranges.items():
+        if state == DONE:
+            done.update(range(start, end))
+    return done
+
+
+def is_claimable(state, claimed):
+    """Returns whether a range with the given state can be claimed
+    """
+    if state == PENDING:
+        return True
+    return state == CLAIMED and claimed < time.time() - CLAIM_TIMEOUT
+
+
+def claim_range(sampleimport):
+    """Claims the first free range and commits the claim. Returns the start
+    and end row of the range, or None if there are no free ranges left.
+    Claims that conflict with the claim of another worker are retried
+    """
+    while True:
+        ranges = get_ranges(sampleimport)
+        if ranges is None:
+            return None
+        free = [(start, end) for start, (end, state, claimed)
+                in ranges.items() if is_claimable(state, claimed)]
+        if not free:
+            return None
+        start, end = free[0]
+        ranges[start] = (end, CLAIMED, time.time())
+        try:
+            transaction.commit()
+            return start, end
+        except ConflictError:
+            transaction.abort()
+
+
+def release_range(sampleimport, start, end, state):
+    """Sets the state of a claimed range. The caller commits
+    """
+    get_ranges(sampleimport)[start] = (end, state, None)
+
+
+def import_ranges(sampleimport, shared, retries, defer_indexing=True,
+                  reserve_ids=True, skip=()):
+    """Claims ranges of the SampleImport and creates their samples until no
+    free ranges are left. Each range is committed on its own and retried
+    after a ConflictError. The reindexing of the objects of a range is
+    deferred to its end if defer_indexing is set, and the sample IDs of a
+    range are reserved in blocks if reserve_ids is set. Rows whose index is
+    in skip are not imported. Returns the collected errors
+    """
+    collector = ErrorCollector()
+    set_collector(sampleimport, collector)
+    client = sampleimport.aq_parent
+    services = ServiceResolver()
+    groups = {}
+    gridrows = sampleimport.getSampleData()
+    try:
+        while True:
+            claimed = claim_range(sampleimport)
+            if claimed is None:
+                break
+            start, end = claimed
+            attempts = 0
+            while True:
+                mark = len(collector)
+                with reserved_ids(end - start, reserve_ids), \
+                        deferred_indexing(defer_indexing):
+                    for index in range(start, end):
+                        if index in skip:
+                            continue
+                        sampleimport.create_sample(
+                            client, gridrows[index], shared, services,
+                            groups)
+                release_range(sampleimport, start, end, DONE)
+                try:
+                    transaction.commit()
+                    break
+                except ConflictError:
+                    transaction.abort()
+                    del collector.entries[mark:]
+                    # resolve the groups again to report their errors again
+                    groups.clear()
+                    attempts += 1
+                    if attempts > retries:
+                        release_range(sampleimport, start, end, PENDING)
+                        transaction.commit()
+                        raise
+                    logger.warn("Conflict while importing rows {}-{}, "
+                                "retrying".format(start + 1, end))
+            logger.info("Imported rows {}-{} of {}".format(
+                start + 1, end, sampleimport.getId()))
+    finally:
+        remove_collector(sampleimport)
+    return collector.entries
+
+
+class RangeWorker(threading.Thread):
+    """Imports ranges of a SampleImport with its own database connection
+    """
+
+    def __init__(self, db, path, site_path, userid, shared, retries,
+                 defer_indexing, reserve_ids, skip):
+        super(RangeWorker, self).__init__()
+        self.db = db
+        self.path = path
+        self.site_path = site_path
+        self.userid = userid
+        self.shared = shared
+        self.retries = retries
+        self.defer_indexing = defer_indexing
+        self.reserve_ids = reserve_ids
+        self.skip = skip
+        self.entries = []
+        self.error = None
+
+    def run(self):
+        conn = self.db.open()
+        try:
+            app = makerequest(conn.root()["Application"])
+            site = app.unrestrictedTraverse(self.site_path)
+            setSite(site)
+            if not login_as(site, self.userid):
+                raise ValueError("User {} not found".format(self.userid))
+            sampleimport = app.unrestrictedTraverse(self.path)
+            self.entries = import_ranges(
+                sampleimport, self.shared, self.retries, self.defer_indexing,
+                self.reserve_ids, self.skip)
+        except Exception as e:
+            logger.exception("Import worker failed")
+            self.error = e
+        finally:
+            transaction.abort()
+            noSecurityManager()
+            setSite(None)
+            conn.close()
+
+
+def import_parallel(sampleimport, start, chunk_size, workers, retries,
+                    defer_indexing=True, reserve_ids=True, skip=()):
+    """Creates the samples of the SampleImport rows from start on with
+    several threads, each claiming ranges of chunk_size rows. Rows whose
+    index is in skip are not imported. Commits the current transaction, so
+    the workers see the ranges. Returns the number of imported rows
+    """
+    total = len(sampleimport.getSampleData())
+    prepare_ranges(sampleimport, start, total, chunk_size)
+    transaction.commit()
+
+    shared = sampleimport.get_import_context()
+    path = api.get_path(sampleimport)
+    site_path = api.get_path(api.get_portal())
+    userid = api.get_current_user().getId()
+    db = sampleimport._p_jar.db()
+    threads = [RangeWorker(db, path, site_path, userid, shared, retries,
+                           defer_indexing, reserve_ids, skip)
+               for num in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # see the commits of the workers
+    transaction.begin()
+    for thread in threads:
+        for entry in thread.entries:
+            sampleimport.error(entry["message"], row=entry["row"],
+                               column=entry["column"], code=entry["code"])
+    ranges = get_ranges(sampleimport)
+    imported = start + get_imported_rows(ranges)
+    if imported < total:
+        failed = [thread.error for thread in threads if thread.error]
+        raise RuntimeError("Imported {} of {} rows: {}".format(
+            imported, total, failed and failed[0]))
+    remove_ranges(sampleimport)
+    return imported
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import csv
+import hashlib
+import mmap
+from StringIO import StringIO
+
+from ZODB.interfaces import BlobError
+
+# Size of the chunks read from the file when splitting it into lines
+CHUNK_SIZE = 1 << 16
+
+# Files larger than this are not kept in memory. Their sample rows are
+# streamed from the blob file each time they are needed instead
+STREAMING_SIZE = 1 << 20
+
+
+class ImportFile(object):
+    """Sections of a sample import file, as found in a single pass:
+
+        header_fields - row with "Header" in column 0
+        header_data - row with "Header Data" in column 0
+        batch_headers - row with "Batch Header" in column 0
+        batch_data - row with "Batch Data" in column 0
+        sample_headers - row with "Samples" in column 0
+        samples - value tuples of all rows below the "Samples" row, or
+            None if the rows have to be streamed from the file
+        nr_samples - number of rows below the "Samples" row
+        source - callable that streams the value tuples of the rows below
+            the "Samples" row from the file, if they are not kept
+    """
+
+    def __init__(self):
+        self.header_fields = []
+        self.header_data = []
+        self.batch_headers = []
+        self.batch_data = []
+        self.sample_headers = None
+        self.samples = []
+        self.nr_samples = 0
+        self.source = None
+
+    def iter_samples(self):
+        """Returns an iterator over the value tuples of the sample rows
+        """
+        if self.sample_headers is None:
+            return iter(())
+        if self.samples is not None:
+            return iter(self.samples)
+        return iter(self.source())
+
+
+def get_blob(fileobj):
+    """Returns the ZODB blob wrapped by the file object, if any
+    """
+    # plone.app.blob's BlobWrapper
+    get_blob = getattr(fileobj, "getBlob", None)
+    if callable(get_blob):
+        return get_blob()
+    # plone.namedfile's NamedBlobFile
+    return getattr(fileobj, "_blob", None)
+
+
+def get_file_key(fileobj):
+    """Returns a key that identifies the current revision of the file
+    """
+    if not fileobj:
+        return None
+    blob = get_blob(fileobj)
+    identity = id(blob) if blob is not None else id(fileobj)
+    return identity, fileobj.getSize()
+
+
+def get_hash(fp, chunk_size=CHUNK_SIZE):
+    """Returns the SHA-256 hex digest of the contents of the file. The file
+    is read in chunks and rewound afterwards
+    """
+    digest = hashlib.sha256()
+    fp.seek(0)
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        digest.update(chunk)
+    fp.seek(0)
+    return digest.hexdigest()
+
+
+def open_file(fileobj):
+    """Returns an open file-like object for reading the file contents. The
+    file of a committed blob is memory mapped where possible
+    """
+    blob = get_blob(fileobj)
+    if blob is None:
+        return StringIO(str(fileobj.data))
+    try:
+        filename = blob.committed()
+    except BlobError:
+        # uncommitted blobs can only be read through the blob itself
+        return blob.open("r")
+    fp = open(filename, "rb")
+    try:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, EnvironmentError):
+        # empty files or file systems without mmap support
+        return fp
+    fp.close()
+    return mapped
+
+
+def is_streaming(fileobj):
+    """Returns whether the sample rows of the file have to be streamed
+    """
+    return fileobj.getSize() > STREAMING_SIZE
+
+
+def has_lines(fp, count):
+    """Returns whether the file has at least count lines. The file is
+    rewound afterwards
+    """
+    found = 0
+    for line in iter_lines(fp):
+        found += 1
+        if found >= count:
+            break
+    fp.seek(0)
+    return found >= count
+
+
+def iter_lines(fp, chunk_size=CHUNK_SIZE):
+    """Yields the lines of the file without line terminators. Splits on the
+    same "\\n", "\\r\\n" and "\\r" terminators as str.splitlines
+    """
+    tail = ""
+    while True:
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            break
+        data = tail + chunk
+        lines = data.splitlines()
+        # The last line might continue in the next chunk. A trailing "\r"
+        # might also be the first half of a "\r\n" terminator
+        if data.endswith("\n"):
+            tail = ""
+        else:
+            tail = lines.pop()
+            if data.endswith("\r"):
+                tail += "\r"
+        for line in lines:
+            yield line
+    if tail:
+        for line in tail.splitlines():
+            yield line
+
+
+def index_of(names, name):
+    """Returns the index of the name in the list, or None if not found
+    """
+    try:
+        return names.index(name)
+    except ValueError:
+        return None
+
+
+class SampleRowFormat(object):
+    """Maps the cells of the rows below the "Samples" row to the sample
+    headers. The TimeSampled column is not a header of its own, its cells are
+    appended to the DateSampled cells instead. Both columns are looked up by
+    name in the "Samples" row
+    """
+
+    def __init__(self, row):
+        names = [x.strip() for x in row]
+        self.date_index = index_of(names, "DateSampled")
+        self.time_index = index_of(names, "TimeSampled")
+        self.headers = [name for indx, name in enumerate(names)
+                        if indx != self.time_index]
+
+    def get_values(self, row):
+        """Returns the cell values of a sample row
+        """
+        date_index = self.date_index
+        time_index = self.time_index
+        if time_index is None:
+            return [x.strip() for x in row]
+        time_sampled = row[time_index].strip() if len(row) > time_index else ""
+        vals = []
+        for indx, x in enumerate(row):
+            if indx == time_index:
+                continue
+            if indx == date_index:
+                vals.append((x.strip() + " " + time_sampled).strip())
+            else:
+                vals.append(x.strip())
+        return vals
+
+
+def iter_rows(lines):
+    """Yields the non-empty csv rows of the lines
+    """
+    for row in csv.reader(lines):
+        if any(row):
+            yield row
+
+
+def iter_samples(lines):
+    """Yields the value tuples of the rows below the "Samples" row
+    """
+    rows = iter_rows(lines)
+    row_format = None
+    for row in rows:
+        if row[0].strip().lower() == "samples":
+            row_format = SampleRowFormat(row)
+            break
+    if row_format is None:
+        return
+    for row in rows:
+        vals = row_format.get_values(row)
+        if any(vals):
+            yield tuple(vals)
+
+
+def parse(lines, keep_samples=True):
+    """Splits the lines of a sample import file into its header, batch
+    header and samples sections in a single pass. Sample rows are counted,
+    but only kept if keep_samples is True
+    """
+    result = ImportFile()
+    if not keep_samples:
+        result.samples = None
+    header_done = batch_done = False
+    row_format = None
+    for row in iter_rows(lines):
+        if row_format is not None:
+            vals = row_format.get_values(row)
+            if not any(vals):
+                continue
+            result.nr_samples += 1
+            if keep_samples:
+                result.samples.append(tuple(vals))
+            continue
+        section = row[0].strip().lower()
+        if section == "header" and not header_done:
+            result.header_fields = [x.strip() for x in row][1:]
+        elif section == "header data" and not header_done:
+            result.header_data = [x.strip() for x in row][1:]
+            header_done = True
+        elif section == "batch header" and not batch_done:
+            result.batch_headers = [x.strip() for x in row][1:]
+        elif section == "batch data" and not batch_done:
+            result.batch_data = [x.strip() for x in row][1:]
+            batch_done = True
+        elif section == "samples":
+            row_format = SampleRowFormat(row)
+            result.sample_headers = row_format.headers
+    return result
+
+
+def parse_file(fileobj):
+    """Reads and parses the contents of the file object. The sample rows of
+    large files are not kept, but have to be streamed with iter_file_samples
+    """
+    fp = open_file(fileobj)
+    try:
+        result = parse(iter_lines(fp), keep_samples=not is_streaming(fileobj))
+    finally:
+        fp.close()
+    result.source = lambda: iter_file_samples(fileobj)
+    return result
+
+
+def parse_upload(fp):
+    """Parses an uploaded file without keeping its sample rows. They are
+    streamed from the upload again when needed
+    """
+    fp.seek(0)
+    result = parse(iter_lines(fp), keep_samples=False)
+
+    def source():
+        fp.seek(0)
+        return iter_samples(iter_lines(fp))
+
+    result.source = source
+    return result
+
+
+def iter_file_samples(fileobj):
+    """Streams the value tuples of the sample rows from the file object
+    """
+    fp = open_file(fileobj)
+    try:
+        for vals in iter_samples(iter_lines(fp)):
+            yield vals
+    finally:
+        fp.close()
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import json
+from itertools import islice
+
+import transaction
+from bika.lims import api
+from bika.lims.utils import tmpID
+from senaite.core.catalog import CONTACT_CATALOG
+from senaite.sampleimporter import errors
+from senaite.sampleimporter import ids
+from senaite.sampleimporter import indexing
+from senaite.sampleimporter import logger
+from senaite.sampleimporter.content.sampleimport import IMPORT_CHUNK_SIZE
+from senaite.sampleimporter.content.sampleimport import IMPORT_DEFER_INDEXING
+from senaite.sampleimporter.content.sampleimport import IMPORT_RESERVE_IDS
+from senaite.sampleimporter.content.sampleimport import IMPORT_RETRIES
+from senaite.sampleimporter.content.sampleimport import SampleImport
+from senaite.sampleimporter.errors import ErrorCollector
+from senaite.sampleimporter.errors import remove_collector
+from senaite.sampleimporter.errors import set_collector
+from senaite.sampleimporter.parser import iter_lines
+from senaite.sampleimporter.resolvers import ReferenceResolver
+from senaite.sampleimporter.resolvers import SamplerIndex
+from senaite.sampleimporter.resolvers import ServiceResolver
+from senaite.sampleimporter.resolvers import get_profile_index
+from senaite.sampleimporter.resolvers import get_samplers
+from ZODB.POSException import ConflictError
+
+# Record keys that list the analyses and profiles of a sample
+LIST_KEYS = ("Analyses", "Profiles")
+
+# Content type of the posted records and of the streamed results
+CONTENT_TYPE = "application/x-ndjson"
+
+
+class InvalidRecord(object):
+    """Stands in for a line that is not a JSON object
+    """
+
+    def __init__(self, message):
+        self.message = message
+
+
+def iter_records(fp):
+    """Yields the JSON records of the lines of the file, one at a time.
+    Lines that are not JSON objects are yielded as InvalidRecord, so the
+    records that follow them are still imported
+    """
+    for line in iter_lines(fp):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield InvalidRecord("Invalid JSON record: %s" % e)
+            continue
+        if not isinstance(record, dict):
+            yield InvalidRecord("Invalid JSON record: not an object")
+            continue
+        yield record
+
+
+def to_cell(value):
+    """Returns the JSON value in the form of a csv cell value
+    """
+    if value is None or value is False:
+        return ""
+    if value is True:
+        return "1"
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return str(value).strip()
+
+
+def to_list(value):
+    """Returns the JSON value of an analyses or profiles key as a list
+    """
+    if not value:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    return filter(None, map(to_cell, value))
+
+
+class RecordImporter(object):
+    """Creates samples from JSON records with the same conversion,
+    validation and creation steps as a SampleImport of a file.
+
+    The header record holds the "Contact" (title or UID) and optionally the
+    "Batch" (title or UID) of the samples. Each sample record maps column
+    names of the "Samples" row to values. The "Analyses" and "Profiles"
+    keys can also list keywords and profiles instead of flagging them
+    """
+
+    def __init__(self, client, header):
+        self.client = client
+        self.sampleimport = SampleImport(tmpID()).__of__(client)
+        self.collector = ErrorCollector()
+
+        self.services = ServiceResolver()
+        self.profiles = get_profile_index().names
+        self.resolver = ReferenceResolver()
+        self.samplers = SamplerIndex(get_samplers(client))
+        self.ar_schema = self.sampleimport.get_ar_schema()
+        # column names -> column plan
+        self.plans = {}
+        self.groups = {}
+        self.shared = self.get_shared(header)
+        set_collector(self.sampleimport, self.collector)
+
+    def get_contact(self, value):
+        """Returns the contact of the client with the value as UID or title
+        """
+        value = to_cell(value)
+        if api.is_uid(value):
+            obj = api.get_object_by_uid(value, None)
+            if obj is not None and api.get_parent(obj) == self.client:
+                return obj
+        query = {
+            "portal_type": "Contact",
+            "Title": value,
+            "path": {"query": api.get_path(self.client)},
+        }
+        brains = api.get_tool(CONTACT_CATALOG)(query)
+        return brains and api.get_object(brains[0]) or None
+
+    def get_batch(self, value):
+        """Returns the batch of the client with the value as UID or title
+        """
+        value = to_cell(value)
+        for batch in self.client.objectValues("Batch"):
+            if value in (api.get_uid(batch), batch.title):
+                return batch
+        return None
+
+    def get_shared(self, header):
+        """Returns the values that are shared by the samples of all records
+        """
+        contact = self.get_contact(header.get("Contact"))
+        if contact is None:
+            raise ValueError("Specified contact '%s' does not exist" %
+                             header.get("Contact"))
+        shared = {"Contact": api.get_uid(contact)}
+        if contact.getCCContact():
+            shared["CCContact"] = map(api.get_uid, contact.getCCContact())
+        if header.get("Batch"):
+            batch = self.get_batch(header["Batch"])
+            if batch is None:
+                raise ValueError("Specified batch '%s' does not exist" %
+                                 header["Batch"])
+            shared["Batch"] = api.get_uid(batch)
+        return shared
+
+    def get_plan(self, names):
+        """Returns the column plan of the record keys
+        """
+        plan = self.plans.get(names)
+        if plan is None:
+            plan = self.plans[names] = self.sampleimport.get_column_plan(
+                self.ar_schema, self.services, self.profiles, self.resolver,
+                self.samplers, headers=names)
+        return plan
+
+    def get_gridrow(self, row_nr, record):
+        """Converts the record to a SampleData row
+        """
+        names = tuple(sorted(key for key in record if key not in LIST_KEYS))
+        plan = self.get_plan(names)
+        vals = [to_cell(record[name]) for name in names]
+        gridrow = self.sampleimport.get_gridrow(plan, row_nr, vals)
+        for key in LIST_KEYS:
+            for value in to_list(record.get(key)):
+                if value not in gridrow[key]:
+                    gridrow[key].append(value)
+        if plan.missing:
+            self.sampleimport.error(
+                "Row %s: Missing expected fields: %s" % (
+                    row_nr, ",".join(plan.missing)), row=row_nr)
+        return gridrow
+
+    def import_record(self, row_nr, record):
+        """Validates the record and creates its sample. Returns the result
+        of the record
+        """
+        mark = len(self.collector)
+        if isinstance(record, InvalidRecord):
+            self.sampleimport.error(
+                "Row %s: %s" % (row_nr, record.message), row=row_nr,
+                code=errors.INVALID)
+            return {"row": row_nr, "errors": self.collector.entries[mark:]}
+        gridrow = self.get_gridrow(row_nr, record)
+        if len(self.collector) == mark:
+            self.sampleimport.validate_gridrow(
+                gridrow, row_nr, self.ar_schema, self.services,
+                self.profiles, self.resolver)
+        if len(self.collector) > mark:
+            return {"row": row_nr, "errors": self.collector.entries[mark:]}
+        sample = self.sampleimport.create_sample(
+            self.client, gridrow, self.shared, self.services, self.groups)
+        if len(self.collector) > mark:
+            # the sample was created, but some analyses were invalid
+            return {"row": row_nr, "id": api.get_id(sample),
+                    "uid": api.get_uid(sample),
+                    "errors": self.collector.entries[mark:]}
+        return {"row": row_nr, "id": api.get_id(sample),
+                "uid": api.get_uid(sample)}
+
+    def rollback(self, size):
+        """Drops the errors and the resolved groups after an aborted chunk
+        """
+        del self.collector.entries[size:]
+        self.groups.clear()
+
+    def close(self):
+        """Removes the error collector of the records
+        """
+        remove_collector(self.sampleimport)
+
+
+def import_records(client, records, chunk_size=IMPORT_CHUNK_SIZE):
+    """Creates the samples of the records that follow the header record.
+    Returns an iterator over the list of results of each chunk of
+    chunk_size records, yielded once its transaction is committed. Only one
+    chunk is held in memory. The header record is read right away, so a
+    ValueError is raised before any sample is created if it is missing or
+    invalid
+    """
+    records = iter(records)
+    header = next(records, None)
+    if header is None:
+        raise ValueError("Missing header record")
+    if isinstance(header, InvalidRecord):
+        raise ValueError("Invalid header record: %s" % header.message)
+    return iter_chunks(RecordImporter(client, header), records, chunk_size)
+
+
+def iter_chunks(importer, records, chunk_size):
+    """Imports the records in chunks of chunk_size records, each one in a
+    transaction of its own, and yields the list of results of each chunk
+    """
+    row_nr = 0
+    try:
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                break
+            attempts = 0
+            while True:
+                mark = len(importer.collector)
+                with ids.reserved_ids(len(chunk), IMPORT_RESERVE_IDS), \
+                        indexing.deferred_indexing(IMPORT_DEFER_INDEXING):
+                    results = [importer.import_record(row_nr + nr, record)
+                               for nr, record in enumerate(chunk, 1)]
+                try:
+                    transaction.commit()
+                except ConflictError:
+                    transaction.abort()
+                    importer.rollback(mark)
+                    attempts += 1
+                    if attempts > IMPORT_RETRIES:
+                        raise
+                    logger.warn("Conflict while importing records {}-{}, "
+                                "retrying".format(row_nr + 1,
+                                                  row_nr + len(chunk)))
+                    continue
+                break
+            row_nr += len(chunk)
+            yield results
+    finally:
+        importer.close()
@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import Missing
+from bika.lims import api
+from bika.lims.utils import getUsers
+from senaite.core.catalog import SAMPLE_CATALOG
+from senaite.core.catalog import SETUP_CATALOG
+from senaite.sampleimporter import logger
+from zope.annotation.interfaces import IAnnotations
+
+# Request annotation key of the Sampler users vocabulary
+SAMPLERS_KEY = "senaite.sampleimporter.samplers"
+
+# Referenced types with at most this many objects are fetched as a whole to
+# match titles regardless of case
+EAGER_LOAD_LIMIT = 1000
+
+
+def normalize(value):
+    """Returns the value in the form used for case-insensitive matching
+    """
+    return str(value).strip().lower()
+
+
+def get_metadata(brain, name):
+    """Returns the metadata column value of the brain, if available
+    """
+    value = getattr(brain, name, None)
+    if value is None or value == Missing.Value:
+        return None
+    if callable(value):
+        return None
+    return value
+
+
+def get_catalog_for(portal_type):
+    """Returns the catalog where objects of the given portal_type are indexed
+    """
+    at = api.get_tool("archetype_tool")
+    # TODO: SampleContainer is not found but Container is found,
+    # could be due to Dexterity vs Archetypes
+    if portal_type == "SampleContainer":
+        portal_type = "Container"
+    catalogs = at.catalog_map.get(portal_type) or [SETUP_CATALOG]
+    return api.get_tool(catalogs[0])
+
+
+def get_client_sample_id_counts(client, client_sample_ids):
+    """Returns a mapping of ClientSampleID -> number of active samples of the
+    client with that ID, for the given IDs. Cancelled and invalid samples
+    are not counted. All samples are fetched with a single catalog query
+    """
+    counts = {}
+    if not client_sample_ids:
+        return counts
+    catalog = api.get_tool(SAMPLE_CATALOG)
+    query = {
+        "getClientUID": api.get_uid(client),
+        "getClientSampleID": list(client_sample_ids),
+        "is_active": True,
+    }
+    for brain in catalog(query):
+        sid = get_metadata(brain, "getClientSampleID")
+        if sid:
+            counts[sid] = counts.get(sid, 0) + 1
+    return counts
+
+
+class ReferenceResolver(object):
+    """Resolves the values of reference columns to UIDs.
+
+    Values can either be the title or the UID of the referenced object. The
+    distinct values of a column can be looked up at once with prefetch, with
+    one catalog query per portal_type for the titles and one for the UIDs,
+    so the number of queries and fetched brains depends on the distinct
+    values of the file, not on the number of rows or referenced objects.
+
+    Values that match no title exactly are matched case-insensitively
+    against all objects of the type, if it has at most EAGER_LOAD_LIMIT
+    objects.
+    """
+
+    def __init__(self):
+        # portal_type -> value -> (title UIDs, whether the value is a UID)
+        self._found = {}
+        # portal_type -> normalized title -> UIDs
+        self._normalized = {}
+
+    def prefetch(self, portal_types, values):
+        """Looks up the values that were not looked up yet
+        """
+        if not isinstance(portal_types, (list, tuple)):
+            portal_types = [portal_types]
+        values = set(str(value).strip() for value in values)
+        values.discard("")
+        for portal_type in portal_types:
+            found = self._found.setdefault(portal_type, {})
+            missing = [value for value in values if value not in found]
+            if not missing:
+                continue
+            titles = dict((value, []) for value in missing)
+            uids = set()
+            catalog = get_catalog_for(portal_type)
+            if "title" in catalog.indexes():
+                for brain in catalog(portal_type=portal_type, title=missing):
+                    title = (brain.Title or "").strip()
+                    if title in titles:
+                        titles[title].append(brain.UID)
+            for brain in catalog(portal_type=portal_type, UID=missing):
+                uids.add(brain.UID)
+            for value in missing:
+                uid_list = titles[value]
+                if not uid_list:
+                    normalized = self.get_normalized(portal_type)
+                    uid_list = normalized.get(normalize(value), [])
+                found[value] = (list(uid_list), value in uids)
+            logger.debug("Looked up {} {} values".format(
+                len(missing), portal_type))
+
+    def get_normalized(self, portal_type):
+        """Returns the normalized title -> UIDs mapping of all objects of the
+        type, or an empty mapping if the type has too many objects
+        """
+        normalized = self._normalized.get(portal_type)
+        if normalized is not None:
+            return normalized
+        normalized = self._normalized[portal_type] = {}
+        catalog = get_catalog_for(portal_type)
+        brains = catalog(portal_type=portal_type)
+        if len(brains) > EAGER_LOAD_LIMIT:
+            logger.warn("Too many {} objects to match titles regardless "
+                        "of case".format(portal_type))
+            return normalized
+        for brain in brains:
+            title = normalize(brain.Title or "")
+            normalized.setdefault(title, []).append(brain.UID)
+        return normalized
+
+    def lookup(self, portal_type, value):
+        """Returns the (title UIDs, whether the value is a UID) of the value
+        """
+        found = self._found.get(portal_type, {})
+        if value not in found:
+            self.prefetch([portal_type], [value])
+            found = self._found[portal_type]
+        return found[value]
+
+    def resolve(self, portal_types, value):
+        """Returns the UIDs of the objects of the given portal_types whose
+        title or UID matches with the value. Titles take precedence
+        """
+        if not isinstance(portal_types, (list, tuple)):
+            portal_types = [portal_types]
+        value = str(value).strip()
+        if not value:
+            return []
+        results = [self.lookup(portal_type, value)
+                   for portal_type in portal_types]
+        for uids, is_uid in results:
+            if uids:
+                return list(uids)
+        for uids, is_uid in results:
+            if is_uid:
+                return [value]
+        return []
+
+    def resolve_uid(self, portal_types, value):
+        """Returns the value if it is the UID of an object of the given
+        portal_types
+        """
+        if not isinstance(portal_types, (list, tuple)):
+            portal_types = [portal_types]
+        value = str(value).strip()
+        if not value:
+            return None
+        for portal_type in portal_types:
+            if self.lookup(portal_type, value)[1]:
+                return value
+        return None
+
+
+class ServiceResolver(object):
+    """Maps the keywords, titles and UIDs of the analysis services to their
+    UIDs. All services are fetched with a single catalog query
+    """
+
+    def __init__(self):
+        self.keywords = {}
+        self.titles = {}
+        self.normalized = {}
+        self.uids = set()
+        catalog = api.get_tool(SETUP_CATALOG)
+        for brain in catalog(portal_type="AnalysisService"):
+            uid = brain.UID
+            keyword = get_metadata(brain, "getKeyword")
+            if keyword is None:
+                keyword = api.get_object(brain).getKeyword()
+            title = (brain.Title or "").strip()
+            self.keywords.setdefault(keyword, uid)
+            self.titles.setdefault(title, uid)
+            self.normalized.setdefault(normalize(title), uid)
+            self.uids.add(uid)
+
+    def is_keyword(self, value):
+        """Returns whether the value is the keyword of a service
+        """
+        return value in self.keywords
+
+    def resolve(self, value):
+        """Returns the UID of the service with the value as keyword, title or
+        UID, in this order of precedence. Returns None if there is no match
+        """
+        uid = self.keywords.get(value)
+        if uid:
+            return uid
+        uid = self.titles.get(value) or self.normalized.get(normalize(value))
+        if uid:
+            return uid
+        if value in self.uids:
+            return value
+        return None
+
+
+class SamplerIndex(object):
+    """Maps the ids and the full names of the samplers to their user ids
+    """
+
+    def __init__(self, samplers):
+        self.names = {}
+        self.normalized = {}
+        self.fullnames = []
+        # partial names that were already looked up
+        self.partial = {}
+        for userid, fullname in samplers.items():
+            if not userid:
+                continue
+            self.fullnames.append((fullname, userid))
+            self.names.setdefault(userid, userid)
+            self.names.setdefault(fullname, userid)
+            self.normalized.setdefault(normalize(fullname), userid)
+
+    def resolve(self, value):
+        """Returns the user id of the sampler with the value as id or full
+        name. Falls back to the first sampler whose full name contains the
+        value. Returns None if there is no match
+        """
+        userid = self.names.get(value) or self.normalized.get(normalize(value))
+        if userid:
+            return userid
+        if value not in self.partial:
+            matches = [uid for name, uid in self.fullnames if value in name]
+            self.partial[value] = matches[0] if matches else None
+        return self.partial[value]
+
+
+def get_samplers(context):
+    """Returns the vocabulary of Sampler users. The users are only fetched
+    once per request
+    """
+    annotations = IAnnotations(context.REQUEST)
+    samplers = annotations.get(SAMPLERS_KEY)
+    if samplers is None:
+        samplers = getUsers(context, ["Sampler"])
+        annotations[SAMPLERS_KEY] = samplers
+    return samplers
+
+
+# Process wide cache of site path -> (setup catalog counter, analysis
+# profile index)
+_profile_indexes = {}
+
+
+class ProfileIndex(object):
+    """Maps the titles, profile keys and UIDs of the analysis profiles to
+    their UIDs and to the UIDs of the services they expand to
+    """
+
+    def __init__(self):
+        # title, profile key or UID -> profile UIDs
+        self.keys = {}
+        # titles and profile keys, which are used as column names
+        self.names = set()
+        # profile UID -> service UIDs
+        self.services = {}
+
+    def add(self, uid, title, profile_key, service_uids):
+        """Adds a profile to the index
+        """
+        for key in (profile_key, uid, title):
+            if not key:
+                continue
+            uids = self.keys.setdefault(key, [])
+            if uid not in uids:
+                uids.append(uid)
+        self.names.update(filter(None, (title, profile_key)))
+        self.services[uid] = frozenset(service_uids)
+
+    def get_uids(self, value):
+        """Returns the UIDs of the profiles matching with the value
+        """
+        return self.keys.get(value, [])
+
+    def get_service_uids(self, value):
+        """Returns the service UIDs of the first profile matching with the
+        value, or None if no profile matches
+        """
+        uids = self.get_uids(value)
+        if not uids:
+            return None
+        return self.services[uids[0]]
+
+
+def build_profile_index():
+    """Builds the index of all analysis profiles from the setup catalog
+    """
+    index = ProfileIndex()
+    catalog = api.get_tool(SETUP_CATALOG)
+    for brain in catalog(portal_type="AnalysisProfile"):
+        profile_key = get_metadata(brain, "getProfileKey")
+        obj = api.get_object(brain)
+        if profile_key is None:
+            profile_key = obj.getProfileKey()
+        # the services are not part of the catalog metadata
+        service_uids = [service["uid"] for service in obj.services]
+        index.add(brain.UID, brain.Title, profile_key, service_uids)
+    logger.info("Built index of {} analysis profiles"
+                .format(len(index.services)))
+    return index
+
+
+def get_setup_counter():
+    """Returns the modification counter of the setup catalog. The counter
+    changes whenever a setup object is (re)indexed or removed, in any
+    process. Returns None if the catalog has no counter
+    """
+    catalog = api.get_tool(SETUP_CATALOG)
+    get_counter = getattr(catalog, "getCounter", None)
+    return get_counter() if get_counter else None
+
+
+def get_profile_index():
+    """Returns the cached analysis profile index of the current site. The
+    index is built again when the setup catalog changed, e.g. by another
+    ZEO client
+    """
+    key = api.get_path(api.get_portal())
+    counter = get_setup_counter()
+    cached = _profile_indexes.get(key)
+    if cached is not None and cached[0] == counter:
+        return cached[1]
+    index = build_profile_index()
+    _profile_indexes[key] = (counter, index)
+    return index
+
+
+def invalidate_profile_index():
+    """Flushes the cached analysis profile indexes
+    """
+    _profile_indexes.clear()
+
+
+# Process wide cache of the AR field descriptors, keyed by site path and
+# the versions of the profiles that define the AR schema
+_ar_fields = {}
+
+# Profiles whose upgrades might change the AR schema
+SCHEMA_PROFILES = (
+    "senaite.core:default",
+    "senaite.sampleimporter:default",
+)
+
+
+class FieldInfo(object):
+    """Describes an AR schema field with the attributes needed to convert
+    and validate the imported values
+    """
+
+    def __init__(self, field):
+        self.name = field.getName()
+        self.type = field.type
+        self.multiValued = bool(getattr(field, "multiValued", False))
+        self.required = bool(getattr(field, "required", False))
+        self.allowed_types = tuple(getattr(field, "allowed_types", None) or ())
+
+
+def get_schema_version():
+    """Returns the versions of the profiles that define the AR schema
+    """
+    setup = api.get_tool("portal_setup")
+    return tuple(map(setup.getLastVersionForProfile, SCHEMA_PROFILES))
+
+
+def build_ar_fields(context):
+    """Builds the field name -> FieldInfo table of the AR schema. The schema
+    is taken from the temporary AR of the SampleImport, so that extended
+    fields are included
+    """
+    ar = context.get_ar()
+    fields = dict((field.getName(), FieldInfo(field))
+                  for field in ar.Schema().fields())
+    logger.info("Built table of {} AR fields".format(len(fields)))
+    return fields
+
+
+def get_ar_fields(context):
+    """Returns the cached field name -> FieldInfo table of the AR schema.
+    The table is built once per process and schema version
+    """
+    key = (api.get_path(api.get_portal()), get_schema_version())
+    fields = _ar_fields.get(key)
+    if fields is None:
+        fields = _ar_fields[key] = build_ar_fields(context)
+    return fields
@@ -26,6 +26,9 @@ from senaite.core.setuphandlers import setup_core_catalogs
 from senaite.sampleimporter import PRODUCT_NAME
 from senaite.sampleimporter import PROFILE_ID
 from senaite.sampleimporter import logger
+from senaite.sampleimporter.catalog import CATALOG_ID
+from senaite.sampleimporter.catalog import TYPES
+from senaite.sampleimporter.catalog import SampleImportCatalog
 
 ACTIONS_TO_HIDE = [
     # Tuples of (id, folder_id)
@@ -51,6 +54,10 @@ ID_FORMATTING = [
 WORKFLOWS_TO_UPDATE = {
 }
 
+CATALOGS = (
+    SampleImportCatalog,
+)
+
 
 def pre_install(portal_setup):
     """Runs before the first import step of the *default* profile
@@ -85,7 +92,7 @@ def post_install(portal_setup):
     client_fti.allowed_content_types = allowed_types
 
     # Setup catalogs
-    # setup_core_catalogs(portal)
+    setup_catalogs(portal)
 
     # Reindex new content types
     reindex_new_content_types(portal)
@@ -116,6 +123,17 @@ def reindex_new_content_types(portal):
         obj.reindexObject()
 
 
+def setup_catalogs(portal):
+    """Adds the catalog of the SampleImports. The SampleImports are only
+    indexed there, not in the portal_catalog
+    """
+    setup_core_catalogs(portal, catalog_classes=CATALOGS)
+    at = api.get_tool("archetype_tool")
+    for portal_type in TYPES:
+        logger.info("Mapping {} to {}".format(portal_type, CATALOG_ID))
+        at.setCatalogsByType(portal_type, [CATALOG_ID])
+
+
 def hide_actions(portal):
     """Excludes actions from both navigation portlet and from control_panel
     """
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import transaction
+from senaite.sampleimporter.resolvers import invalidate_profile_index
+
+
+def after_commit_invalidate(func):
+    """Calls the function now and once more after the current transaction
+    is committed, so that other threads do not cache the old state
+    """
+    func()
+    transaction.get().addAfterCommitHook(lambda success: func())
+
+
+def on_profile_changed(profile, event):
+    """Event handler for added, modified and removed analysis profiles
+    """
+    after_commit_invalidate(invalidate_profile_index)
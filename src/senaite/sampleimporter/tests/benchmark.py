@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Generator of synthetic sample import files and the measurements of the
+benchmark in test_benchmark.py
+"""
+
+import csv
+import json
+import os
+import random
+import resource
+import subprocess
+import time
+
+from senaite.sampleimporter import timing
+
+# Benchmark scenarios. Each one imports a file with the given number of
+# rows, with as many service and profile columns and as many distinct
+# sample points as listed
+SCENARIOS = [
+    {"name": "1k", "rows": 1000, "services": 5, "profiles": 2,
+     "sample_points": 10},
+    {"name": "10k", "rows": 10000, "services": 20, "profiles": 5,
+     "sample_points": 100},
+    {"name": "100k", "rows": 100000, "services": 50, "profiles": 10,
+     "sample_points": 1000},
+]
+
+# Stages whose timings are reported, in the order they run
+STAGES = (
+    "parse",
+    "save_header_data",
+    "save_sample_data",
+    "create_or_reference_batch",
+    "validate",
+    "import",
+)
+
+
+def get_scenarios(names):
+    """Returns the scenarios with the given names, or all of them if no
+    names are given
+    """
+    if not names:
+        return list(SCENARIOS)
+    return [scenario for scenario in SCENARIOS if scenario["name"] in names]
+
+
+def write_csv(fp, rows, keywords, profiles, sample_points, client_name,
+              client_id, contact, sample_type="Water", seed=0):
+    """Writes a sample import file with the given number of rows to fp.
+    Each row selects a random subset (at least one) of the services and
+    the profiles and one of the sample points. The same seed gives the same
+    file
+    """
+    rand = random.Random(seed)
+    writer = csv.writer(fp)
+    writer.writerow(["Header", "Client name", "Client ID", "Contact"])
+    writer.writerow(["Header Data", client_name, client_id, contact])
+    writer.writerow(["Samples", "ClientSampleID", "DateSampled",
+                     "SamplePoint", "SampleType"] +
+                    list(keywords) + list(profiles))
+    for nr in range(1, rows + 1):
+        services = [int(rand.random() < 0.3) for keyword in keywords]
+        if not any(services):
+            services[rand.randrange(len(services))] = 1
+        selected = [int(rand.random() < 0.1) for profile in profiles]
+        writer.writerow([
+            "Sample %s" % nr,
+            "BM-%s-%07d" % (seed, nr),
+            "3/9/2014",
+            rand.choice(sample_points),
+            sample_type,
+        ] + services + selected)
+
+
+def get_peak_memory():
+    """Returns the peak resident memory of the process in kB. This is the
+    high-water mark of the whole process, including earlier scenarios
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Measurement(object):
+    """Collects the stage timings and the peak memory of a scenario
+    """
+
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.started = time.time()
+
+    def get_result(self, sampleimport):
+        """Returns the result of the scenario as a dict
+        """
+        timings = timing.get_timings(sampleimport)
+        stages = {}
+        for stage in STAGES:
+            record = timings.get(stage)
+            if record is None:
+                continue
+            stages[stage] = {
+                "seconds": record["seconds"],
+                "rows": record["rows"],
+                "rows_per_sec": record["rows_per_sec"],
+            }
+        return dict(self.scenario,
+                    seconds=time.time() - self.started,
+                    process_peak_memory_kb=get_peak_memory(),
+                    stages=stages)
+
+
+def get_commit():
+    """Returns the git commit of the working tree, if any
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=os.path.dirname(__file__)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(path, results):
+    """Writes the results of the scenarios as JSON
+    """
+    data = {
+        "commit": get_commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": results,
+    }
+    with open(path, "w") as fp:
+        json.dump(data, fp, indent=2, sort_keys=True)
@@ -18,17 +18,36 @@
 # Copyright 2018-2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
+import json
 import re
+import time
+from StringIO import StringIO
 
 import transaction
+from bika.lims import api
 from bika.lims.catalog import (CATALOG_ANALYSIS_LISTING,
                                CATALOG_ANALYSIS_REQUEST_LISTING)
 from bika.lims.utils import tmpID
 from bika.lims.workflow import doActionFor, getCurrentState
 from plone.app.testing import (TEST_USER_ID, TEST_USER_NAME,
                                TEST_USER_PASSWORD, login, setRoles)
+from plone.protect.authenticator import createToken
 from Products.CMFCore.utils import getToolByName
 from Products.CMFPlone.utils import _createObjectByType
+from ZODB.POSException import ConflictError
+from zExceptions import Forbidden
+from zope.annotation.interfaces import IAnnotations
+from senaite.sampleimporter import jobs
+from senaite.sampleimporter import parser
+from senaite.sampleimporter.content.sampleimport import SampleImport
+from senaite.sampleimporter import parallel
+from senaite.sampleimporter import records
+from senaite.sampleimporter import timing
+from senaite.sampleimporter import validation
+from senaite.sampleimporter.browser.sampleimporter import \
+    SampleImportRecordsView
+from senaite.sampleimporter.browser.sampleimporter import SampleImportsView
+from senaite.sampleimporter.catalog import CATALOG_ID as SAMPLEIMPORT_CATALOG
 from senaite.sampleimporter.tests.base import SimpleTestCase
 
 try:
@@ -168,6 +187,425 @@ Samples    ,ClientSampleID ,DateSampled    ,TimeSampled ,Sampler  ,SamplePoint
         if states != ['registered'] * 12:
             self.fail('Analysis states should all be registered, but are not!')
 
+        # the stages are timed
+        timings = timing.get_timings(sampleimport)
+        self.assertEqual(timings["import"]["rows"], 4)
+        self.assertEqual(timings["validate"]["rows"], 4)
+        self.assertIn("save_sample_data", timings)
+
+        # the listings render from the catalog metadata
+        catalog = getToolByName(self.portal, SAMPLEIMPORT_CATALOG)
+        brain = catalog(UID=sampleimport.UID())[0]
+        self.assertEqual(brain.getFilename, "test1.csv")
+        # stored as integer, so the listings sort numerically
+        self.assertEqual(brain.getNrSamples, 4)
+        self.assertEqual(brain.getClientPath, api.get_path(client))
+        self.assertEqual(brain.getContactPath,
+                         api.get_path(sampleimport.getContact()))
+        # the current titles are looked up when the listing is rendered
+        client.setName("Sunny Hills")
+        client.reindexObject()
+        view = SampleImportsView(self.portal, self.request)
+        item = view.folderitem(brain, {"replace": {}}, 0)
+        self.assertNotIn("Client", item)
+        view.render_references()
+        self.assertEqual(item["Client"], "Sunny Hills")
+        self.assertIn(client.absolute_url(), item["replace"]["Client"])
+        self.assertEqual(item["Contact"],
+                         api.get_title(sampleimport.getContact()))
+        self.assertTrue(brain.getDateValidated)
+        self.assertTrue(brain.getDateImported)
+        self.assertFalse(pc(portal_type="SampleImport"))
+        self.assertEqual(len(catalog(review_state="imported",
+                                     getClientID=client.getClientID())), 1)
+
+    def test_chunked_import_resumes_from_checkpoint(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = self.addthing(client, 'SampleImport')
+        sampleimport.unmarkCreationFlag()
+        sampleimport.setFilename("test1.csv")
+        sampleimport.setOriginalFile("""
+Header    ,Client name    ,Client ID       ,Contact
+Header Data    ,Happy Hills    ,HH         ,Rita Mohale
+Samples    ,ClientSampleID ,DateSampled    ,SamplePoint    ,SampleType ,ECO  ,SAL
+"Sample 1"    ,HHS14001    ,3/9/2014       ,  Toilet ,  Water    ,1    ,0
+"Sample 2"    ,HHS14002    ,3/9/2014       ,  Toilet ,  Water    ,0    ,1
+"Sample 3"    ,HHS14003    ,3/9/2014       ,  Toilet ,  Water    ,1    ,1
+        """)
+        sampleimport.setErrors([])
+        sampleimport.save_header_data()
+        sampleimport.save_sample_data()
+        sampleimport.REQUEST.response.write = lambda x: x
+        workflow.doActionFor(sampleimport, 'validate')
+        self.assertEqual(sampleimport.getImportedRows(), 0)
+
+        # the first two rows are committed as one chunk, the third one
+        # is left to the current transaction
+        sampleimport.import_samples(chunk_size=2)
+        self.assertEqual(sampleimport.getImportedRows(), 3)
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 3)
+
+        # importing again resumes after the checkpoint
+        sampleimport.import_samples(chunk_size=2)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 3)
+
+        # rows whose samples exist already can be skipped
+        rows = sampleimport.getSampleData()
+        self.assertEqual(
+            sampleimport.get_existing_rows(client, rows, mode="skip"),
+            frozenset([0, 1, 2]))
+        self.assertEqual(
+            sampleimport.get_existing_rows(client, rows, mode="create"),
+            frozenset())
+
+        # or reported
+        rows.append(dict(rows[0], ClientSampleID="HHS14004"))
+        sampleimport.setErrors([])
+        existing = sampleimport.get_existing_rows(client, rows, mode="flag")
+        self.assertEqual(existing, frozenset([0, 1, 2]))
+        self.assertEqual(
+            [e["row"] for e in sampleimport.getErrorEntries()], [1, 2, 3])
+
+        # cancelled samples do not count
+        sample = barc(portal_type='AnalysisRequest',
+                      getClientSampleID="HHS14001")[0].getObject()
+        doActionFor(sample, "cancel")
+        self.assertEqual(
+            sampleimport.get_existing_rows(client, rows, mode="skip"),
+            frozenset([1, 2]))
+
+    def test_import_retries_conflicting_chunk(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = self.addthing(client, 'SampleImport')
+        sampleimport.unmarkCreationFlag()
+        sampleimport.setFilename("test1.csv")
+        sampleimport.setOriginalFile("""
+Header    ,Client name    ,Client ID       ,Contact
+Header Data    ,Happy Hills    ,HH         ,Rita Mohale
+Samples    ,ClientSampleID ,DateSampled    ,SamplePoint    ,SampleType ,ECO  ,SAL
+"Sample 1"    ,HHS14001    ,3/9/2014       ,  Toilet ,  Water    ,1    ,0
+"Sample 2"    ,HHS14002    ,3/9/2014       ,  Toilet ,  Water    ,0    ,1
+"Sample 3"    ,HHS14003    ,3/9/2014       ,  Toilet ,  Water    ,1    ,1
+        """)
+        sampleimport.setErrors([])
+        sampleimport.save_header_data()
+        sampleimport.save_sample_data()
+        sampleimport.REQUEST.response.write = lambda x: x
+        workflow.doActionFor(sampleimport, 'validate')
+        # the aborted chunk must not roll back the SampleImport itself
+        transaction.commit()
+
+        def conflict():
+            raise ConflictError("forced conflict")
+
+        conflicts = []
+        create_sample = SampleImport.create_sample
+
+        def create_and_report(self, client, therow, *args, **kwargs):
+            self.error("Row %s: checked" % therow["ClientSampleID"])
+            if not conflicts:
+                # the first chunk fails to commit once
+                conflicts.append(therow["ClientSampleID"])
+                transaction.get().addBeforeCommitHook(conflict)
+            return create_sample(self, client, therow, *args, **kwargs)
+
+        SampleImport.create_sample = create_and_report
+        try:
+            sampleimport.import_samples(chunk_size=1)
+        finally:
+            SampleImport.create_sample = create_sample
+        self.assertEqual(conflicts, ["HHS14001"])
+        self.assertEqual(sampleimport.getImportedRows(), 3)
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 3)
+        # the errors of the retried chunk are reported once
+        self.assertEqual(list(sampleimport.getErrors()), [
+            "Row HHS14001: checked", "Row HHS14002: checked",
+            "Row HHS14003: checked"])
+
+    def test_parallel_import(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = self.addthing(client, 'SampleImport')
+        sampleimport.unmarkCreationFlag()
+        sampleimport.setFilename("test1.csv")
+        sampleimport.setOriginalFile("""
+Header    ,Client name    ,Client ID       ,Contact
+Header Data    ,Happy Hills    ,HH         ,Rita Mohale
+Samples    ,ClientSampleID ,DateSampled    ,SamplePoint    ,SampleType ,ECO  ,SAL
+"Sample 1"    ,HHS14001    ,3/9/2014       ,  Toilet ,  Water    ,1    ,0
+"Sample 2"    ,HHS14002    ,3/9/2014       ,  Toilet ,  Water    ,0    ,1
+"Sample 3"    ,HHS14003    ,3/9/2014       ,  Toilet ,  Water    ,1    ,1
+"Sample 4"    ,HHS14004    ,3/9/2014       ,  Toilet ,  Water    ,1    ,0
+        """)
+        sampleimport.setErrors([])
+        sampleimport.save_header_data()
+        sampleimport.save_sample_data()
+        sampleimport.REQUEST.response.write = lambda x: x
+        workflow.doActionFor(sampleimport, 'validate')
+
+        # two threads import the four ranges of one row each
+        sampleimport.import_samples(chunk_size=1, workers=2)
+        self.assertEqual(sampleimport.getImportedRows(), 4)
+        self.assertIsNone(parallel.get_ranges(sampleimport))
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        self.assertEqual(len(barc(portal_type='AnalysisRequest')), 4)
+
+    def test_resume_parallel_import(self):
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = self.addthing(client, 'SampleImport')
+        sampleimport.unmarkCreationFlag()
+        sampleimport.setFilename("test1.csv")
+        sampleimport.setOriginalFile("""
+Header    ,Client name    ,Client ID       ,Contact
+Header Data    ,Happy Hills    ,HH         ,Rita Mohale
+Samples    ,ClientSampleID ,DateSampled    ,SamplePoint    ,SampleType ,ECO  ,SAL
+"Sample 1"    ,HHS14001    ,3/9/2014       ,  Toilet ,  Water    ,1    ,0
+"Sample 2"    ,HHS14002    ,3/9/2014       ,  Toilet ,  Water    ,0    ,1
+"Sample 3"    ,HHS14003    ,3/9/2014       ,  Toilet ,  Water    ,1    ,1
+"Sample 4"    ,HHS14004    ,3/9/2014       ,  Toilet ,  Water    ,1    ,0
+        """)
+        sampleimport.setErrors([])
+        sampleimport.save_header_data()
+        sampleimport.save_sample_data()
+        sampleimport.REQUEST.response.write = lambda x: x
+        workflow.doActionFor(sampleimport, 'validate')
+
+        # ranges of other rows are dropped
+        parallel.prepare_ranges(sampleimport, 0, 3, 2)
+        self.assertFalse(parallel.has_ranges(sampleimport, 4))
+        self.assertIsNone(parallel.get_ranges(sampleimport))
+
+        # a parallel import that stopped after its first range is resumed
+        # in ranges by a single worker
+        parallel.prepare_ranges(sampleimport, 0, 4, 2)
+        parallel.release_range(sampleimport, 0, 2, parallel.DONE)
+        sampleimport.import_samples(chunk_size=2, workers=1)
+        self.assertEqual(sampleimport.getImportedRows(), 4)
+        self.assertIsNone(parallel.get_ranges(sampleimport))
+        barc = getToolByName(self.portal, CATALOG_ANALYSIS_REQUEST_LISTING)
+        samples = barc(portal_type='AnalysisRequest')
+        self.assertEqual(sorted(b.getClientSampleID for b in samples),
+                         ["HHS14003", "HHS14004"])
+
+        # saving the rows again drops the ranges
+        parallel.prepare_ranges(sampleimport, 0, 4, 2)
+        sampleimport.save_sample_data()
+        self.assertIsNone(parallel.get_ranges(sampleimport))
+
+    def test_queued_validate_job(self):
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = self.addthing(client, 'SampleImport')
+        sampleimport.unmarkCreationFlag()
+        sampleimport.setFilename("test1.csv")
+        sampleimport.setOriginalFile("""
+Header    ,Client name    ,Client ID       ,Contact
+Header Data    ,Happy Hills    ,HH         ,Rita Mohale
+Samples    ,ClientSampleID ,DateSampled    ,SamplePoint    ,SampleType ,ECO
+"Sample 1"    ,HHS14001    ,3/9/2014       ,  Toilet ,  Water    ,1
+        """)
+        self.assertTrue(jobs.queue_job(sampleimport, "validate"))
+        self.assertFalse(jobs.queue_job(sampleimport, "validate"))
+        self.assertEqual(jobs.get_job(sampleimport)["state"], jobs.QUEUED)
+        self.assertEqual(getCurrentState(sampleimport), 'invalid')
+        transaction.commit()
+
+        # a job that is running in another worker is not claimed, unless
+        # its claim timed out
+        job = jobs.get_job(sampleimport)
+        job["state"] = jobs.RUNNING
+        job["claimed"] = time.time()
+        transaction.commit()
+        self.assertFalse(jobs.run_next_job(self.portal))
+        self.assertTrue(jobs.is_pending(sampleimport))
+        job["claimed"] = time.time() - jobs.CLAIM_TIMEOUT - 1
+        transaction.commit()
+        self.assertFalse(jobs.is_pending(sampleimport))
+
+        # the worker runs the job as the user that queued it
+        self.assertTrue(jobs.run_next_job(self.portal))
+        self.assertFalse(jobs.run_next_job(self.portal))
+        login(self.portal, TEST_USER_NAME)
+        self.assertEqual(jobs.get_job(sampleimport)["state"], jobs.DONE)
+        self.assertEqual(getCurrentState(sampleimport), 'valid')
+
+        view = sampleimport.restrictedTraverse("sampleimport_progress")
+        progress = view.get_progress()
+        self.assertEqual(progress["review_state"], 'valid')
+        self.assertEqual(progress["processed"], 1)
+        self.assertEqual(progress["total"], 1)
+
+    def test_queue_view(self):
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = self.addthing(client, 'SampleImport')
+        sampleimport.unmarkCreationFlag()
+        sampleimport.setFilename("test1.csv")
+        sampleimport.setOriginalFile("""
+Header    ,Client name    ,Client ID       ,Contact
+Header Data    ,Happy Hills    ,HH         ,Rita Mohale
+Samples    ,ClientSampleID ,DateSampled    ,SamplePoint    ,SampleType ,ECO
+"Sample 1"    ,HHS14001    ,3/9/2014       ,  Toilet ,  Water    ,1
+        """)
+        # saving the edit form queues the validation
+        sampleimport.at_post_edit_script()
+        self.assertEqual(jobs.get_job(sampleimport)["action"], "revalidate")
+        IAnnotations(sampleimport).pop(jobs.JOB_KEY)
+
+        # jobs are only queued with a POST that carries the authenticator
+        self.request.form["action"] = "import"
+        self.request["REQUEST_METHOD"] = "POST"
+        view = sampleimport.restrictedTraverse("sampleimport_queue")
+        self.assertRaises(Forbidden, view)
+        self.assertIsNone(jobs.get_job(sampleimport))
+        self.request.form["_authenticator"] = createToken()
+        view()
+        self.assertEqual(jobs.get_job(sampleimport)["action"], "import")
+
+    def test_job_conflict_retries(self):
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = self.addthing(client, 'SampleImport')
+        sampleimport.unmarkCreationFlag()
+        self.assertTrue(jobs.queue_job(sampleimport, "validate"))
+        transaction.commit()
+
+        def conflict(sampleimport):
+            raise ConflictError("forced conflict")
+
+        run_validate = jobs.ACTIONS["validate"]
+        jobs.ACTIONS["validate"] = conflict
+        try:
+            runs = 0
+            while jobs.run_next_job(self.portal):
+                runs += 1
+        finally:
+            jobs.ACTIONS["validate"] = run_validate
+        login(self.portal, TEST_USER_NAME)
+        # the job is run again until it runs out of retries
+        self.assertEqual(runs, jobs.JOB_RETRIES + 1)
+        job = jobs.get_job(sampleimport)
+        self.assertEqual(job["state"], jobs.FAILED)
+        self.assertEqual(job["attempts"], jobs.JOB_RETRIES + 1)
+        self.assertFalse(jobs.get_queue(self.portal))
+
+    def test_dry_run(self):
+        client = self.portal.clients.objectValues()[0]
+        sampleimport = SampleImport(tmpID()).__of__(client)
+        sampleimport.set_import_file(parser.parse("""
+Header    ,Client name    ,Client ID       ,Contact
+Header Data    ,Happy Hills    ,HH         ,Rita Mohale
+Samples    ,ClientSampleID ,DateSampled    ,SamplePoint    ,SampleType ,ECO
+"Sample 1"    ,HHS14001    ,3/9/2014       ,  Toilet ,  Water    ,1
+"Sample 2"    ,HHS14002    ,3/9/2014       ,  Nowhere ,  Water    ,1
+        """.splitlines()))
+        entries = sampleimport.dry_run()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]["row"], 2)
+        self.assertEqual(entries[0]["column"], "SamplePoint")
+        self.assertEqual(len(sampleimport.getSampleData()), 2)
+        self.assertFalse(client.objectValues('SampleImport'))
+
+    def test_revalidate_changed_rows(self):
+        client = self.portal.clients.objectValues()[0]
+        validation.invalidate()
+        sampleimport = SampleImport(tmpID()).__of__(client)
+        sampleimport.set_import_file(parser.parse("""
+Header    ,Client name    ,Client ID       ,Contact
+Header Data    ,Happy Hills    ,HH         ,Rita Mohale
+Samples    ,ClientSampleID ,DateSampled    ,SamplePoint    ,SampleType ,ECO
+"Sample 1"    ,HHS14001    ,3/9/2014       ,  Toilet ,  Water    ,1
+"Sample 2"    ,HHS14002    ,3/9/2014       ,  Toilet ,  Water    ,1
+"Sample 3"    ,HHS14003    ,3/9/2014       ,  Toilet ,  Water    ,1
+        """.splitlines()))
+        sampleimport.save_header_data(dry_run=True)
+        sampleimport.save_sample_data()
+        rows = sampleimport.getSampleData()
+        rows[1]["Analyses"] = ["NOTAKEYWORD"]
+        rows[2]["Analyses"] = ["NOTAKEYWORD"]
+        sampleimport.setSampleData(rows)
+        sampleimport.validate_sample_import()
+        self.assertEqual(
+            [e["row"] for e in sampleimport.getErrorEntries()], [2, 2, 3, 3])
+
+        # fix the third row; only that row is validated again
+        rows = sampleimport.getSampleData()
+        rows[2]["Analyses"] = ["ECO"]
+        sampleimport.setSampleData(rows)
+        validated = []
+        validate_gridrow = sampleimport.validate_gridrow
+
+        def count(gridrow, row_nr, *args):
+            validated.append(row_nr)
+            return validate_gridrow(gridrow, row_nr, *args)
+        sampleimport.validate_gridrow = count
+        sampleimport.validate_sample_import()
+        self.assertEqual(validated, [3])
+        self.assertEqual(
+            [e["row"] for e in sampleimport.getErrorEntries()], [2, 2])
+
+        # all rows are validated again once the setup changed
+        del validated[:]
+        self.portal.bika_setup.bika_sampletypes.objectValues()[0] \
+            .reindexObject()
+        sampleimport.validate_sample_import()
+        self.assertEqual(validated, [1, 2, 3])
+
+    def test_import_records(self):
+        client = self.portal.clients.objectValues()[0]
+        lines = [
+            '{"Contact": "Rita Mohale"}',
+            '{"ClientSampleID": "HHS14001", "DateSampled": "3/9/2014", '
+            '"SampleType": "Water", "Analyses": ["ECO"]}',
+            '',
+            '{"ClientSampleID": "HHS14003", ',
+            '["HHS14004"]',
+            '{"ClientSampleID": "HHS14002", "DateSampled": "3/9/2014", '
+            '"SamplePoint": "Nowhere", "SampleType": "Water", "ECO": 1}',
+        ]
+        fp = StringIO("\n".join(lines))
+        chunks = records.import_records(
+            client, records.iter_records(fp), chunk_size=1)
+        results = [result for chunk in chunks for result in chunk]
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0]["row"], 1)
+        self.assertTrue(results[0]["uid"])
+        # lines that are no JSON objects are reported, the import goes on
+        for result in results[1:3]:
+            self.assertNotIn("uid", result)
+            self.assertEqual(result["errors"][0]["code"], "invalid")
+        self.assertEqual(results[3]["row"], 4)
+        self.assertNotIn("uid", results[3])
+        self.assertEqual(results[3]["errors"][0]["column"], "SamplePoint")
+
+        sample = self.portal.reference_catalog.lookupObject(results[0]["uid"])
+        self.assertEqual(sample.getClientSampleID(), "HHS14001")
+        self.assertEqual(
+            [a.getKeyword for a in sample.getAnalyses()], ["ECO"])
+
+        # the header record is checked before any sample is created
+        self.assertRaises(
+            ValueError, records.import_records, client,
+            records.iter_records(StringIO('["Rita Mohale"]')))
+
+    def test_records_view(self):
+        client = self.portal.clients.objectValues()[0]
+        request = self.portal.REQUEST
+        request.set("REQUEST_METHOD", "POST")
+        request.environ["CONTENT_TYPE"] = "application/x-www-form-urlencoded"
+        request.set("BODYFILE", StringIO('{"Contact": "Rita Mohale"}'))
+        view = SampleImportRecordsView(client, request)
+        # form posts are refused
+        view()
+        self.assertEqual(request.response.getStatus(), 415)
+        request.environ["CONTENT_TYPE"] = "application/x-ndjson"
+        request.set("BODYFILE", StringIO('["Rita Mohale"]'))
+        result = json.loads(view())
+        self.assertEqual(request.response.getStatus(), 400)
+        self.assertTrue(result["error"].startswith("Invalid header record"))
+
     def test_LIMS_2080_correctly_interpret_false_and_blank_values(self):
         client = self.portal.clients.objectValues()[0]
         sampleimport = self.addthing(client, 'SampleImport')
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+"""Benchmark of the parse, save, validate and import stages with synthetic
+files. It is only run if SENAITE_SAMPLEIMPORTER_BENCHMARK is set to "all"
+or to a comma separated list of scenario names (see benchmark.SCENARIOS):
+
+    SENAITE_SAMPLEIMPORTER_BENCHMARK=1k,10k bin/test -t test_benchmark
+
+The results are written as JSON to SENAITE_SAMPLEIMPORTER_BENCHMARK_OUTPUT
+(default: sampleimporter-benchmark.json), to compare them across commits.
+The peak memory is the high-water mark of the test process, so run one
+scenario at a time to get the peak memory of a scenario
+"""
+
+import os
+import tempfile
+
+import transaction
+from bika.lims.utils import tmpID
+from bika.lims.workflow import getCurrentState
+from plone.app.testing import TEST_USER_ID
+from plone.app.testing import TEST_USER_NAME
+from plone.app.testing import login
+from plone.app.testing import setRoles
+from Products.CMFCore.utils import getToolByName
+from Products.CMFPlone.utils import _createObjectByType
+from senaite.sampleimporter import validation
+from senaite.sampleimporter.resolvers import invalidate_profile_index
+from senaite.sampleimporter.tests import benchmark
+from senaite.sampleimporter.tests.base import SimpleTestCase
+
+try:
+    import unittest2 as unittest
+except ImportError:  # Python 2.7
+    import unittest
+
+ENV_BENCHMARK = "SENAITE_SAMPLEIMPORTER_BENCHMARK"
+ENV_OUTPUT = "SENAITE_SAMPLEIMPORTER_BENCHMARK_OUTPUT"
+
+
+def get_scenario_names():
+    """Returns the names of the scenarios to run, or None to run all
+    """
+    value = os.environ.get(ENV_BENCHMARK, "").strip()
+    if value.lower() == "all":
+        return None
+    return [name.strip() for name in value.split(",") if name.strip()]
+
+
+class TestBenchmark(SimpleTestCase):
+
+    def addthing(self, folder, portal_type, **kwargs):
+        thing = _createObjectByType(portal_type, folder, tmpID())
+        thing.unmarkCreationFlag()
+        thing.edit(**kwargs)
+        thing._renameAfterCreation()
+        return thing
+
+    def setUp(self):
+        super(TestBenchmark, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Member', 'LabManager'])
+        login(self.portal, TEST_USER_NAME)
+        self.scenarios = benchmark.get_scenarios(get_scenario_names())
+        setup = self.portal.bika_setup
+        self.client = self.addthing(
+            self.portal.clients, 'Client', title='Benchmark', ClientID='BM')
+        self.contact = self.addthing(
+            self.client, 'Contact', Firstname='Bench', Lastname='Mark')
+        self.addthing(setup.bika_sampletypes, 'SampleType',
+                      title='Water', Prefix='H2O')
+
+        # as many setup objects as the largest scenario needs
+        nr_services = max(s["services"] for s in self.scenarios)
+        nr_profiles = max(s["profiles"] for s in self.scenarios)
+        nr_points = max(s["sample_points"] for s in self.scenarios)
+        self.keywords = ["BM%02d" % nr for nr in range(nr_services)]
+        services = [
+            self.addthing(setup.bika_analysisservices, 'AnalysisService',
+                          title='Service %s' % keyword, Keyword=keyword)
+            for keyword in self.keywords]
+        self.profiles = ["Profile %02d" % nr for nr in range(nr_profiles)]
+        for nr, title in enumerate(self.profiles):
+            uids = [services[(nr + offset) % len(services)].UID()
+                    for offset in range(2)]
+            self.addthing(setup.bika_analysisprofiles, 'AnalysisProfile',
+                          title=title, Service=uids)
+        self.sample_points = ["Point %04d" % nr for nr in range(nr_points)]
+        for title in self.sample_points:
+            self.addthing(setup.bika_samplepoints, 'SamplePoint', title=title)
+        transaction.commit()
+
+    def run_scenario(self, scenario, seed):
+        """Imports a generated file of the scenario and returns the result
+        """
+        # start without the caches of the previous scenario
+        validation.invalidate()
+        invalidate_profile_index()
+        measurement = benchmark.Measurement(scenario)
+
+        sampleimport = self.addthing(self.client, 'SampleImport')
+        sampleimport.setFilename("benchmark.csv")
+        fp = tempfile.TemporaryFile()
+        try:
+            benchmark.write_csv(
+                fp, scenario["rows"],
+                self.keywords[:scenario["services"]],
+                self.profiles[:scenario["profiles"]],
+                self.sample_points[:scenario["sample_points"]],
+                self.client.Title(), self.client.getClientID(),
+                self.contact.Title(), seed=seed)
+            fp.seek(0)
+            sampleimport.setOriginalFile(fp, filename="benchmark.csv")
+        finally:
+            fp.close()
+        transaction.commit()
+
+        # the workflow scripts use response.write(); silence them
+        sampleimport.REQUEST.response.write = lambda x: x
+        workflow = getToolByName(self.portal, 'portal_workflow')
+        sampleimport.setErrors([])
+        sampleimport.get_import_file()
+        sampleimport.save_header_data()
+        sampleimport.save_sample_data()
+        sampleimport.create_or_reference_batch()
+        workflow.doActionFor(sampleimport, 'validate')
+        self.assertEqual(getCurrentState(sampleimport), 'valid',
+                         sampleimport.getErrors()[:10])
+        workflow.doActionFor(sampleimport, 'import')
+        self.assertEqual(getCurrentState(sampleimport), 'imported')
+        transaction.commit()
+        return measurement.get_result(sampleimport)
+
+    def test_benchmark(self):
+        results = []
+        for seed, scenario in enumerate(self.scenarios):
+            result = self.run_scenario(scenario, seed)
+            results.append(result)
+        output = os.environ.get(ENV_OUTPUT, "sampleimporter-benchmark.json")
+        benchmark.write_results(output, results)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    if os.environ.get(ENV_BENCHMARK):
+        suite.addTest(unittest.makeSuite(TestBenchmark))
+    return suite
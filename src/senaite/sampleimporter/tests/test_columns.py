@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from senaite.sampleimporter import columns
+
+
+class Services(object):
+    """Stands in for the ServiceResolver
+    """
+
+    def is_keyword(self, value):
+        return value in ("Ca", "Fe")
+
+
+class TestColumnPlan(unittest.TestCase):
+    """Test the classification of the "Samples" columns
+    """
+
+    def compile(self, headers):
+        ar_schema = ("ClientSampleID", "DateSampled", "Sampler", "Profiles")
+        converters = {"Sampler": "sampler", columns.FIELD: "field"}
+        return columns.compile_plan(
+            headers, ar_schema, Services(), ("Metals",), converters)
+
+    def test_kinds(self):
+        plan = self.compile(["Samples", "ClientSampleID", "Sampler", "Ca",
+                             "Metals", "Price", "", "Profiles"])
+        kinds = [(col.index, col.kind) for col in plan.columns]
+        self.assertEqual(kinds, [(0, columns.SPECIAL), (1, columns.FIELD),
+                                 (2, columns.SPECIAL), (3, columns.SERVICE),
+                                 (4, columns.PROFILE), (5, columns.UNKNOWN),
+                                 (7, columns.UNKNOWN)])
+        self.assertEqual(plan.columns[1].converter, "field")
+        self.assertEqual(plan.columns[2].converter, "sampler")
+        self.assertEqual(plan.unexpected, ["Price", "Profiles"])
+        self.assertEqual(plan.get_index("Samples"), 0)
+
+    def test_missing(self):
+        self.assertEqual(self.compile(["Samples"]).missing, ["SampleType"])
+        self.assertEqual(self.compile(["Samples", "SampleType"]).missing, [])
+
+    def test_is_checked(self):
+        for value in ("1", "x", "True"):
+            self.assertTrue(columns.is_checked(value))
+        for value in ("", " 0 ", "false", "FALSE"):
+            self.assertFalse(columns.is_checked(value))
+
+    def test_row_hash(self):
+        row = {"sid": "Sample 1", "SampleType": "Water",
+               "Analyses": ["Ca", "Fe"], "Profiles": []}
+        # the edit form submits every column, blank or not
+        edited = {"sid": "Sample 1", "SampleType": u"Water ",
+                  "SamplePoint": "", "Analyses": ("Ca", "Fe", ""),
+                  "Profiles": ("",)}
+        self.assertEqual(columns.get_row_hash(row),
+                         columns.get_row_hash(edited))
+        edited["SamplePoint"] = "Toilet"
+        self.assertNotEqual(columns.get_row_hash(row),
+                            columns.get_row_hash(edited))
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestColumnPlan))
+    return suite
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from senaite.sampleimporter import errors
+
+
+class Stages(object):
+    """Stands in for a SampleImport with two nested stages
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def error(self, msg, **kwargs):
+        errors.get_collector(self).add(msg, **kwargs)
+
+    def store_errors(self, entries):
+        self.writes.append(list(entries))
+
+    @errors.collect_errors
+    def outer(self):
+        self.error("outer", code=errors.MISSING)
+        self.inner()
+
+    @errors.collect_errors
+    def inner(self):
+        for row in range(1, 1001):
+            self.error("Row %s" % row, row=row, column="SampleType",
+                       code=errors.INVALID)
+
+    @errors.collect_errors
+    def invalidated(self):
+        self.error("before")
+        # like a transaction abort, which drops the volatile attributes
+        self.__dict__.clear()
+        self.writes = []
+        self.error("after")
+
+
+class TestErrorCollector(unittest.TestCase):
+    """Test the collection of the errors of an import stage
+    """
+
+    def test_single_write(self):
+        stages = Stages()
+        stages.outer()
+        self.assertEqual(len(stages.writes), 1)
+        entries = stages.writes[0]
+        self.assertEqual(len(entries), 1001)
+        self.assertEqual(entries[0]["message"], "outer")
+        self.assertEqual(entries[1], {"row": 1, "column": "SampleType",
+                                      "code": errors.INVALID,
+                                      "message": "Row 1"})
+        self.assertIsNone(errors.get_collector(stages))
+
+    def test_invalidated(self):
+        stages = Stages()
+        stages.invalidated()
+        self.assertEqual(len(stages.writes), 1)
+        self.assertEqual([entry["message"] for entry in stages.writes[0]],
+                         ["before", "after"])
+        self.assertIsNone(errors.get_collector(stages))
+
+    def test_no_errors(self):
+        stages = Stages()
+        stages.inner()
+        stages.inner()
+        self.assertEqual(len(stages.writes), 2)
+        stages = Stages()
+        errors.collect_errors(lambda self: None)(stages)
+        self.assertEqual(stages.writes, [])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestErrorCollector))
+    return suite
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from bika.lims.numbergenerator import NumberGenerator
+from senaite.sampleimporter import ids
+
+
+class Storage(dict):
+    """Stands in for the stored numbers
+    """
+    _p_oid = "numbers"
+
+
+class Generator(object):
+    """Stands in for the number generator
+    """
+
+    def __init__(self):
+        self.numbers = self.storage = Storage()
+        self.writes = 0
+
+    def get_number(self, key):
+        # generates the next number, like the number generator does
+        self.writes += 1
+        self.numbers[key] = self.numbers.get(key, 0) + 1
+        return self.numbers[key]
+
+    def set_number(self, key, value):
+        self.writes += 1
+        self.numbers[key] = value
+
+    def generate_number(self, key="default"):
+        return self.get_number(key)
+
+
+class TestReservation(unittest.TestCase):
+    """Test the reservation of sequence numbers in blocks
+    """
+
+    def setUp(self):
+        self._generate_number = ids._generate_number
+        self._run_detached = ids.run_detached
+        ids._generate_number = Generator.generate_number
+        # the numbers as last committed
+        self.committed = Generator()
+        ids.run_detached = self.run_detached
+
+    def tearDown(self):
+        ids._generate_number = self._generate_number
+        ids.run_detached = self._run_detached
+
+    def run_detached(self, func, generator, *args):
+        return func(self.committed, *args)
+
+    def test_blocks(self):
+        generator = Generator()
+        reservation = ids.Reservation(3, detach=False)
+        numbers = [reservation.generate(generator, "H2O") for i in range(4)]
+        self.assertEqual(numbers, [1, 2, 3, 4])
+        self.assertEqual(reservation.generate(generator, "AIR"), 1)
+        # two blocks of H2O and one of AIR, two writes each
+        self.assertEqual(generator.writes, 6)
+        self.assertEqual(generator.numbers, {"H2O": 6, "AIR": 3})
+
+        # the unused numbers are given back
+        reservation.release()
+        self.assertEqual(generator.numbers, {"H2O": 4, "AIR": 1})
+
+    def test_release_after_concurrent_use(self):
+        generator = Generator()
+        reservation = ids.Reservation(5, detach=False)
+        reservation.generate(generator, "H2O")
+        generator.generate_number("H2O")
+        reservation.release()
+        self.assertEqual(generator.numbers, {"H2O": 6})
+
+    def test_committed_blocks(self):
+        generator = Generator()
+        self.committed.numbers["H2O"] = 10
+        reservation = ids.Reservation(3)
+        numbers = [reservation.generate(generator, "H2O") for i in range(2)]
+        self.assertEqual(numbers, [11, 12])
+        # the counter of the import transaction is not written
+        self.assertEqual(generator.writes, 0)
+        self.assertEqual(self.committed.numbers, {"H2O": 13})
+        reservation.release()
+        self.assertEqual(self.committed.numbers, {"H2O": 12})
+
+    def test_uncommitted_numbers(self):
+        generator = Generator()
+        generator.generate_number("H2O")
+        reservation = ids.Reservation(3)
+        # the number generated by the import transaction is not committed
+        self.assertEqual(reservation.generate(generator, "H2O"), 2)
+        self.assertEqual(generator.numbers, {"H2O": 4})
+        self.assertEqual(self.committed.numbers, {})
+        # the storage is not stored in the database yet
+        generator.storage._p_oid = None
+        reservation = ids.Reservation(3)
+        self.assertEqual(reservation.generate(generator, "AIR"), 1)
+        self.assertEqual(self.committed.numbers, {})
+
+
+class TestInstall(unittest.TestCase):
+    """Test the installation of the reservation into the number generator
+    """
+
+    def test_scoped_install(self):
+        generate_number = NumberGenerator.__dict__["generate_number"]
+        with ids.reserved_ids(3):
+            with ids.reserved_ids(3):
+                self.assertIs(NumberGenerator.__dict__["generate_number"],
+                              ids.generate_number)
+            self.assertIs(NumberGenerator.__dict__["generate_number"],
+                          ids.generate_number)
+        # the number generator is restored when the last block ends
+        self.assertIs(NumberGenerator.__dict__["generate_number"],
+                      generate_number)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestReservation))
+    suite.addTest(unittest.makeSuite(TestInstall))
+    return suite
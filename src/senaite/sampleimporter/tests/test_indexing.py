@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from bika.lims.utils import tmpID
+from plone.app.testing import TEST_USER_ID, TEST_USER_NAME, login, setRoles
+from Products.CMFCore.indexing import INDEX
+from Products.CMFCore.indexing import REINDEX
+from Products.CMFCore.indexing import UNINDEX
+from Products.CMFPlone.utils import _createObjectByType
+from senaite.sampleimporter import resolvers
+from senaite.sampleimporter.indexing import DeferredOperations
+from senaite.sampleimporter.indexing import deferred_indexing
+from senaite.sampleimporter.tests.base import SimpleTestCase
+
+
+class Dummy(object):
+    """Stands in for a cataloged object
+    """
+
+
+class TestDeferredOperations(unittest.TestCase):
+    """Test the merging of the deferred reindex operations
+    """
+
+    def test_merge(self):
+        obj, other = Dummy(), Dummy()
+        deferred = DeferredOperations()
+        self.assertTrue(deferred.add(REINDEX, obj, ["review_state"], 0))
+        self.assertTrue(deferred.add(REINDEX, other, [], 1))
+        self.assertTrue(deferred.add(REINDEX, obj, ["getId"], 1))
+        operations = deferred.get_operations()
+        self.assertEqual(len(operations), 2)
+        op, merged, attributes, metadata = operations[0]
+        self.assertIs(merged, obj)
+        self.assertEqual(sorted(attributes), ["getId", "review_state"])
+        self.assertEqual(metadata, 1)
+        self.assertEqual(deferred.merged, 1)
+
+        # a full reindex wins over partial ones
+        deferred.add(REINDEX, other, ["getId"], 0)
+        self.assertEqual(deferred.get_operations()[1][2:], ([], 1))
+
+    def test_other_operations(self):
+        obj = Dummy()
+        deferred = DeferredOperations()
+        deferred.add(REINDEX, obj, [], 1)
+        self.assertFalse(deferred.add(UNINDEX, obj, None, None))
+        self.assertEqual(deferred.get_operations(), [])
+        self.assertFalse(deferred.add(INDEX, obj, None, None))
+
+
+class TestDeferredIndexing(SimpleTestCase):
+    """Test the catalog state while the reindexing is deferred
+    """
+
+    def setUp(self):
+        super(TestDeferredIndexing, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Member', 'LabManager'])
+        login(self.portal, TEST_USER_NAME)
+        folder = self.portal.bika_setup.bika_samplepoints
+        self.samplepoint = _createObjectByType('SamplePoint', folder, tmpID())
+        self.samplepoint.unmarkCreationFlag()
+        self.samplepoint.edit(title='Toilet')
+        self.samplepoint._renameAfterCreation()
+        self.catalog = resolvers.get_catalog_for('SamplePoint')
+
+    def get_titles(self):
+        return [brain.Title for brain in self.catalog(
+            portal_type='SamplePoint', UID=self.samplepoint.UID())]
+
+    def test_searches_see_deferred_reindexes(self):
+        with deferred_indexing():
+            self.samplepoint.setTitle('Bathroom')
+            self.samplepoint.reindexObject()
+            # the search flushes the deferred reindex first
+            self.assertEqual(self.get_titles(), ['Bathroom'])
+            self.samplepoint.setTitle('Kitchen')
+            self.samplepoint.reindexObject()
+            self.samplepoint.reindexObject(idxs=['title'])
+            self.assertEqual(self.get_titles(), ['Kitchen'])
+            self.samplepoint.setTitle('Garden')
+            self.samplepoint.reindexObject()
+        # the end of the block flushes the rest
+        self.assertEqual(self.get_titles(), ['Garden'])
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestDeferredOperations))
+    suite.addTest(unittest.makeSuite(TestDeferredIndexing))
+    return suite
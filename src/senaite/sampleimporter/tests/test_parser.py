@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import hashlib
+import unittest
+from StringIO import StringIO
+
+from senaite.sampleimporter import parser
+
+CSV = """Header,Client name,Client ID,Contact
+Header Data,Happy Hills,HH,Rita Mohale
+Batch Header,title,description,ClientBatchID
+Batch Data,New Batch,Optional descr,CC 201506
+Samples,ClientSampleID,DateSampled,TimeSampled,Sampler,SamplePoint
+Sample 1,HHS14001,3/9/2014,9:00,,Toilet
+,,,,,
+
+Sample 2,HHS14002,3/9/2014,9:25,,Toilet
+"""
+
+
+class TestParser(unittest.TestCase):
+    """Test the single pass parser of the sample import files
+    """
+
+    def test_sections(self):
+        import_file = parser.parse(CSV.splitlines())
+        self.assertEqual(import_file.header_fields,
+                         ["Client name", "Client ID", "Contact"])
+        self.assertEqual(import_file.header_data,
+                         ["Happy Hills", "HH", "Rita Mohale"])
+        self.assertEqual(import_file.batch_headers,
+                         ["title", "description", "ClientBatchID"])
+        self.assertEqual(import_file.batch_data,
+                         ["New Batch", "Optional descr", "CC 201506"])
+        self.assertEqual(import_file.sample_headers,
+                         ["Samples", "ClientSampleID", "DateSampled",
+                          "Sampler", "SamplePoint"])
+
+    def test_samples(self):
+        import_file = parser.parse(CSV.splitlines())
+        self.assertEqual(len(import_file.samples), 2)
+        self.assertEqual(import_file.samples[0],
+                         ("Sample 1", "HHS14001", "3/9/2014 9:00", "",
+                          "Toilet"))
+
+    def test_streaming(self):
+        import_file = parser.parse(CSV.splitlines(), keep_samples=False)
+        self.assertIsNone(import_file.samples)
+        self.assertEqual(import_file.nr_samples, 2)
+        samples = list(parser.iter_samples(CSV.splitlines()))
+        self.assertEqual(samples, parser.parse(CSV.splitlines()).samples)
+
+    def test_time_sampled(self):
+        # TimeSampled is merged into DateSampled by name, not by position
+        lines = ["Samples,ClientSampleID,SamplingDate,TimeSampled ,"
+                 "DateSampled,SampleType",
+                 "Sample 1,HHS14001,3/8/2014,9:00,3/9/2014,Water"]
+        import_file = parser.parse(lines)
+        self.assertEqual(import_file.sample_headers,
+                         ["Samples", "ClientSampleID", "SamplingDate",
+                          "DateSampled", "SampleType"])
+        self.assertEqual(import_file.samples[0],
+                         ("Sample 1", "HHS14001", "3/8/2014",
+                          "3/9/2014 9:00", "Water"))
+        # without TimeSampled, all cells are kept as they are
+        import_file = parser.parse([lines[0].replace("TimeSampled ", "X"),
+                                    lines[1]])
+        self.assertEqual(import_file.samples[0][3:5], ("9:00", "3/9/2014"))
+
+    def test_has_lines(self):
+        self.assertTrue(parser.has_lines(StringIO(CSV), 3))
+        self.assertFalse(parser.has_lines(StringIO("a\nb\n"), 3))
+
+    def test_iter_lines(self):
+        data = "a,b\r\nc,d\re,f\n\ng,h"
+        for chunk_size in (1, 2, 3, 5, 1024):
+            lines = list(parser.iter_lines(StringIO(data), chunk_size))
+            self.assertEqual(lines, data.splitlines())
+
+    def test_get_hash(self):
+        fp = StringIO(CSV)
+        fp.read(10)
+        digest = parser.get_hash(fp, chunk_size=7)
+        self.assertEqual(digest, hashlib.sha256(CSV).hexdigest())
+        # the file is rewound for the parser
+        self.assertEqual(fp.tell(), 0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestParser))
+    return suite
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+from bika.lims.utils import tmpID
+from plone.app.testing import TEST_USER_ID, TEST_USER_NAME, login, setRoles
+from Products.CMFPlone.utils import _createObjectByType
+from senaite.sampleimporter import resolvers
+from senaite.sampleimporter.tests.base import SimpleTestCase
+
+try:
+    import unittest2 as unittest
+except ImportError:  # Python 2.7
+    import unittest
+
+
+class TestSamplerIndex(unittest.TestCase):
+    """Test the lookup of the samplers
+    """
+
+    def setUp(self):
+        self.index = resolvers.SamplerIndex({
+            "": "",
+            "rita": "Rita Mohale",
+            "lab1": "Lab Sampler One",
+        })
+
+    def test_id_and_fullname(self):
+        self.assertEqual(self.index.resolve("rita"), "rita")
+        self.assertEqual(self.index.resolve("Rita Mohale"), "rita")
+        self.assertEqual(self.index.resolve(" rita mohale "), "rita")
+
+    def test_partial_fallback(self):
+        self.assertEqual(self.index.resolve("Sampler"), "lab1")
+        self.assertEqual(self.index.partial, {"Sampler": "lab1"})
+        self.assertEqual(self.index.resolve("Nobody"), None)
+        self.assertEqual(self.index.partial["Nobody"], None)
+
+
+class TestProfileIndex(unittest.TestCase):
+    """Test the index of the analysis profiles
+    """
+
+    def test_lookup(self):
+        index = resolvers.ProfileIndex()
+        index.add("uid1", "MicroBio", "MB", ["a", "b"])
+        index.add("uid2", "Properties", "", ["c"])
+        self.assertEqual(index.names, set(["MicroBio", "MB", "Properties"]))
+        for value in ("uid1", "MicroBio", "MB"):
+            self.assertEqual(index.get_uids(value), ["uid1"])
+            self.assertEqual(index.get_service_uids(value),
+                             frozenset(["a", "b"]))
+        self.assertEqual(index.get_uids("Unknown"), [])
+        self.assertEqual(index.get_service_uids("Unknown"), None)
+
+
+class TestResolvers(SimpleTestCase):
+    """Test the lookup of the referenced setup objects
+    """
+
+    def addthing(self, folder, portal_type, **kwargs):
+        thing = _createObjectByType(portal_type, folder, tmpID())
+        thing.unmarkCreationFlag()
+        thing.edit(**kwargs)
+        thing._renameAfterCreation()
+        return thing
+
+    def setUp(self):
+        super(TestResolvers, self).setUp()
+        setRoles(self.portal, TEST_USER_ID, ['Member', 'LabManager'])
+        login(self.portal, TEST_USER_NAME)
+        setup = self.portal.bika_setup
+        self.toilet = self.addthing(
+            setup.bika_samplepoints, 'SamplePoint', title='Toilet')
+        self.upper = self.addthing(
+            setup.bika_samplepoints, 'SamplePoint', title='TOILET')
+        # titled with the UID of another sample point
+        self.decoy = self.addthing(
+            setup.bika_samplepoints, 'SamplePoint', title=self.toilet.UID())
+        self.water = self.addthing(
+            setup.bika_sampletypes, 'SampleType', title='Water',
+            Prefix='H2O')
+        self.ecoli = self.addthing(
+            setup.bika_analysisservices, 'AnalysisService',
+            title='Ecoli', Keyword="ECO")
+        # titled with the keyword of another service
+        self.other = self.addthing(
+            setup.bika_analysisservices, 'AnalysisService',
+            title='ECO', Keyword="OTH")
+
+    def tearDown(self):
+        resolvers.invalidate_profile_index()
+        super(TestResolvers, self).tearDown()
+
+    def test_reference_precedence(self):
+        resolver = resolvers.ReferenceResolver()
+        # exact titles take precedence over the case-insensitive match
+        self.assertEqual(resolver.resolve("SamplePoint", "TOILET"),
+                         [self.upper.UID()])
+        self.assertEqual(sorted(resolver.resolve("SamplePoint", " toilet ")),
+                         sorted([self.toilet.UID(), self.upper.UID()]))
+        # titles take precedence over UIDs
+        self.assertEqual(resolver.resolve("SamplePoint", self.toilet.UID()),
+                         [self.decoy.UID()])
+        self.assertEqual(
+            resolver.resolve_uid("SamplePoint", self.toilet.UID()),
+            self.toilet.UID())
+        self.assertEqual(resolver.resolve("SampleType", self.water.UID()),
+                         [self.water.UID()])
+        self.assertEqual(resolver.resolve_uid("SampleType", "Water"), None)
+        self.assertEqual(resolver.resolve(["SamplePoint", "SampleType"],
+                                          "water"), [self.water.UID()])
+        self.assertEqual(resolver.resolve("SampleType", "Nowhere"), [])
+        self.assertEqual(resolver.resolve("SampleType", "  "), [])
+
+    def test_reference_prefetch(self):
+        resolver = resolvers.ReferenceResolver()
+        resolver.prefetch(["SampleType"], ["Water", "water", "Nowhere"])
+        # prefetched values are not looked up again
+        get_catalog_for = resolvers.get_catalog_for
+        calls = []
+
+        def counting(portal_type):
+            calls.append(portal_type)
+            return get_catalog_for(portal_type)
+
+        resolvers.get_catalog_for = counting
+        try:
+            self.assertEqual(resolver.resolve("SampleType", "Water"),
+                             [self.water.UID()])
+            self.assertEqual(resolver.resolve("SampleType", "water"),
+                             [self.water.UID()])
+            self.assertEqual(resolver.resolve("SampleType", "Nowhere"), [])
+            self.assertEqual(calls, [])
+            resolver.resolve("SampleType", "Soil")
+            self.assertEqual(calls, ["SampleType"])
+        finally:
+            resolvers.get_catalog_for = get_catalog_for
+
+    def test_service_precedence(self):
+        resolver = resolvers.ServiceResolver()
+        self.assertTrue(resolver.is_keyword("ECO"))
+        self.assertFalse(resolver.is_keyword("Ecoli"))
+        # keywords take precedence over titles
+        self.assertEqual(resolver.resolve("ECO"), self.ecoli.UID())
+        self.assertEqual(resolver.resolve("Ecoli"), self.ecoli.UID())
+        self.assertEqual(resolver.resolve(" ecoli "), self.ecoli.UID())
+        self.assertEqual(resolver.resolve(self.other.UID()),
+                         self.other.UID())
+        self.assertEqual(resolver.resolve("Unknown"), None)
+
+    def test_profile_index_invalidation(self):
+        index = resolvers.get_profile_index()
+        self.assertTrue(resolvers.get_profile_index() is index)
+        self.assertFalse("MicroBio" in index.names)
+        profile = self.addthing(
+            self.portal.bika_setup.bika_analysisprofiles, 'AnalysisProfile',
+            title='MicroBio', Service=[self.ecoli.UID()])
+        # the new profile changed the setup catalog
+        index = resolvers.get_profile_index()
+        self.assertEqual(index.get_uids("MicroBio"), [profile.UID()])
+        self.assertEqual(index.get_service_uids("MicroBio"),
+                         frozenset([self.ecoli.UID()]))
+        resolvers.invalidate_profile_index()
+        self.assertFalse(resolvers.get_profile_index() is index)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSamplerIndex))
+    suite.addTest(unittest.makeSuite(TestProfileIndex))
+    suite.addTest(unittest.makeSuite(TestResolvers))
+    return suite
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from senaite.sampleimporter import timing
+from zope.annotation.attribute import AttributeAnnotations
+from zope.annotation.interfaces import IAnnotations
+from zope.annotation.interfaces import IAttributeAnnotatable
+from zope.component import provideAdapter
+from zope.interface import implementer
+
+
+@implementer(IAttributeAnnotatable)
+class Stage(object):
+    """Stands in for the SampleImport
+    """
+
+    def getId(self):
+        return "SI-00001"
+
+    @timing.timed("count", rows=lambda self, result: result)
+    def count(self, rows):
+        return rows
+
+    @timing.timed("fail")
+    def fail(self):
+        raise ValueError("failed")
+
+
+class TestTiming(unittest.TestCase):
+    """Test the timing of the import stages
+    """
+
+    def setUp(self):
+        provideAdapter(AttributeAnnotations, (IAttributeAnnotatable,),
+                       IAnnotations)
+
+    def test_timed(self):
+        stage = Stage()
+        self.assertEqual(stage.count(10), 10)
+        record = timing.get_timings(stage)["count"]
+        self.assertEqual(record["rows"], 10)
+        self.assertFalse(record["failed"])
+        self.assertTrue(record["seconds"] >= 0)
+
+    def test_failed(self):
+        stage = Stage()
+        self.assertRaises(ValueError, stage.fail)
+        record = timing.get_timings(stage)["fail"]
+        self.assertTrue(record["failed"])
+        self.assertEqual(record["rows"], None)
+        self.assertEqual(record["rows_per_sec"], None)
+
+    def test_rate(self):
+        timer = timing.StageTimer("parse")
+        timer.rows = 100
+        timer.seconds = 2.0
+        self.assertEqual(timer.get_rate(), 50.0)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTiming))
+    return suite
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import unittest
+
+from senaite.sampleimporter import validation
+
+
+class TestValidationCache(unittest.TestCase):
+    """Test the cache of the validated rows
+    """
+
+    def test_lru(self):
+        cache = validation.LRUCache(2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        # "b" is the least recently used now
+        cache.set("c", 3)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual(len(cache), 2)
+
+    def test_disabled(self):
+        cache = validation.LRUCache(0)
+        cache.set("a", 1)
+        self.assertEqual(cache.get("a"), None)
+
+    def test_outcome(self):
+        key = ("/plone", 1, ())
+        entry = {"row": 3, "column": "Analyses", "code": "invalid",
+                 "message": "Row 3: value is invalid (Analysis keyword=X)"}
+        validation.set_outcome(key, "hash", 3, [entry])
+        found = validation.get_outcome(key, "hash", 7)
+        self.assertEqual(found[0]["row"], 7)
+        self.assertEqual(found[0]["message"],
+                         "Row 7: value is invalid (Analysis keyword=X)")
+        # another setup counter does not match
+        self.assertEqual(
+            validation.get_outcome(("/plone", 2, ()), "hash", 7), None)
+        self.assertEqual(validation.get_outcome(None, "hash", 7), None)
+        validation.invalidate()
+        self.assertEqual(validation.get_outcome(key, "hash", 7), None)
+
+
+def test_suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestValidationCache))
+    return suite
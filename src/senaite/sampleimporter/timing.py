@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from DateTime import DateTime
+from persistent.mapping import PersistentMapping
+from senaite.sampleimporter import logger
+from zope.annotation.interfaces import IAnnotations
+
+# Annotation key of the stage timings on the SampleImport
+TIMINGS_KEY = "senaite.sampleimporter.timings"
+
+
+class StageTimer(object):
+    """Measures the wall time of a stage. The number of rows the stage
+    handled can be set while it runs
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.rows = None
+        self.started = time.time()
+        self.seconds = None
+
+    def stop(self):
+        self.seconds = time.time() - self.started
+
+    def get_rate(self):
+        """Returns the rows per second, or None
+        """
+        if self.rows is None or not self.seconds:
+            return None
+        return self.rows / self.seconds
+
+    def to_dict(self, failed=False):
+        return {
+            "seconds": self.seconds,
+            "rows": self.rows,
+            "rows_per_sec": self.get_rate(),
+            "failed": failed,
+            "finished": DateTime(),
+        }
+
+
+def get_timings(sampleimport):
+    """Returns the mapping of stage -> timing of the last run of each stage
+    of the SampleImport
+    """
+    return IAnnotations(sampleimport).get(TIMINGS_KEY) or {}
+
+
+def store_timing(sampleimport, timer, failed=False):
+    """Stores the timing of the stage on the SampleImport and logs it
+    """
+    record = timer.to_dict(failed=failed)
+    annotations = IAnnotations(sampleimport)
+    timings = annotations.get(TIMINGS_KEY)
+    if timings is None:
+        timings = annotations[TIMINGS_KEY] = PersistentMapping()
+    timings[timer.stage] = record
+
+    message = "{}: {} {} in {:.3f}s".format(
+        sampleimport.getId(), timer.stage,
+        "failed" if failed else "done", timer.seconds)
+    if timer.rows is not None:
+        message += " for {} rows".format(timer.rows)
+    if record["rows_per_sec"] is not None:
+        message += " ({:.1f} rows/s)".format(record["rows_per_sec"])
+    logger.info(message)
+
+
+@contextmanager
+def timed_stage(sampleimport, stage):
+    """Measures the block as the given stage of the SampleImport. Yields the
+    StageTimer, whose rows can be set by the block
+    """
+    timer = StageTimer(stage)
+    try:
+        yield timer
+    except Exception:
+        timer.stop()
+        store_timing(sampleimport, timer, failed=True)
+        raise
+    timer.stop()
+    store_timing(sampleimport, timer)
+
+
+def timed(stage, rows=None):
+    """Decorator for the stage methods of a SampleImport. The rows function
+    is called with the SampleImport and the result of the stage and returns
+    the number of rows it handled
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with timed_stage(self, stage) as timer:
+                result = func(self, *args, **kwargs)
+                if rows is not None:
+                    timer.rows = rows(self, result)
+            return result
+        return wrapper
+    return decorator
@@ -18,10 +18,13 @@
 # Copyright 2019 by it's authors.
 # Some rights reserved, see README and LICENSE.
 
+from bika.lims import api
 from senaite.core.upgrade import upgradestep
 from senaite.sampleimporter import PRODUCT_NAME
 from senaite.sampleimporter import logger
 from senaite.sampleimporter import PROJECTNAME as product
+from senaite.sampleimporter import parser
+from senaite.sampleimporter.setuphandlers import setup_catalogs
 
 version = "1.0.1"
 profile = "profile-{0}:default".format(product)
@@ -31,5 +34,46 @@ def upgrade(tool):
     portal = tool.aq_inner.aq_parent
     setup = portal.portal_setup
     setup.runImportStepFromProfile(profile, "workflow")
+    move_sample_imports(portal)
     logger.info("{0} upgraded to version {1}".format(PRODUCT_NAME, version))
     return True
+
+
+def move_sample_imports(portal):
+    """Moves the SampleImports from the portal_catalog to their own catalog
+    and stores the hash of their original files and their number of samples
+    as integer
+    """
+    portal_catalog = api.get_tool("portal_catalog")
+    paths = [brain.getPath() for brain in
+             portal_catalog(portal_type="SampleImport")]
+    setup_catalogs(portal)
+    for path in paths:
+        obj = portal.unrestrictedTraverse(path)
+        set_file_hash(obj)
+        set_nr_samples(obj)
+        obj.reindexObject()
+        portal_catalog.uncatalog_object(path)
+    logger.info("Moved {} SampleImports to their catalog".format(len(paths)))
+
+
+def set_file_hash(obj):
+    """Stores the hash of the original file of the SampleImport
+    """
+    fileobj = obj.getOriginalFile()
+    if not fileobj or obj.getFileHash():
+        return
+    fp = parser.open_file(fileobj)
+    try:
+        obj.setFileHash(parser.get_hash(fp))
+    finally:
+        fp.close()
+
+
+def set_nr_samples(obj):
+    """Stores the number of samples, which was stored as string before
+    """
+    field = obj.getField("NrSamples")
+    value = field.get(obj)
+    if isinstance(value, basestring):
+        field.set(obj, int(value.strip() or 0))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of SENAITE.SAMPLEIMPORTER.
+#
+# SENAITE.SAMPLEIMPORTER is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the Free
+# Software Foundation, version 2.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc., 51
+# Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+#
+# Copyright 2019 by it's authors.
+# Some rights reserved, see README and LICENSE.
+
+import os
+import threading
+from collections import OrderedDict
+
+from bika.lims import api
+from senaite.sampleimporter.resolvers import get_schema_version
+from senaite.sampleimporter.resolvers import get_setup_counter
+
+# Number of validated rows whose outcome is kept per process. 0 disables
+# the cache
+CACHE_SIZE = int(os.environ.get(
+    "SENAITE_SAMPLEIMPORTER_VALIDATION_CACHE", 10000))
+
+
+class LRUCache(object):
+    """Thread-safe mapping that holds the most recently used size entries
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        """Returns the value of the key and marks it as recently used
+        """
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is None:
+                return default
+            self.entries[key] = value
+            return value
+
+    def set(self, key, value):
+        """Adds the value, dropping the least recently used entry if full
+        """
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Process wide cache of row key -> (row number, error entries) of the
+# validated SampleData rows
+_outcomes = LRUCache(CACHE_SIZE)
+
+
+def get_version_key():
+    """Returns the part of the row keys that refers to the current state of
+    the setup, or None if the state of the setup cannot be told
+    """
+    counter = get_setup_counter()
+    if counter is None:
+        return None
+    return (api.get_path(api.get_portal()), counter, get_schema_version())
+
+
+def renumber(message, old_nr, new_nr):
+    """Returns the message of a row error for another row number
+    """
+    prefix = "Row %s:" % old_nr
+    if old_nr == new_nr or not message.startswith(prefix):
+        return message
+    return "Row %s:" % new_nr + message[len(prefix):]
+
+
+def get_outcome(version_key, row_hash, row_nr):
+    """Returns the cached error entries of a row with the given content
+    hash, numbered for row_nr, or None if the row was not validated yet
+    """
+    if version_key is None:
+        return None
+    outcome = _outcomes.get((version_key, row_hash))
+    if outcome is None:
+        return None
+    old_nr, entries = outcome
+    return [dict(entry, row=row_nr,
+                 message=renumber(entry["message"], old_nr, row_nr))
+            for entry in entries]
+
+
+def set_outcome(version_key, row_hash, row_nr, entries):
+    """Caches the error entries of a validated row
+    """
+    if version_key is None:
+        return
+    _outcomes.set((version_key, row_hash), (row_nr, tuple(entries)))
+
+
+def invalidate():
+    """Flushes the cached outcomes
+    """
+    _outcomes.clear()